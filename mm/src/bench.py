@@ -0,0 +1,218 @@
+import json, os, platform, shutil, tempfile
+from datetime import datetime, timezone
+from time import monotonic
+from pathlib import Path
+import log, version, emulator
+import serial_download as sd
+
+
+BENCH_FAMILIES = ['ram', 'partition', 'sd', 'file']
+BENCH_DEFAULT_FAMILIES = 'ram,sd,file'
+BENCH_RAM_ADDRESS = 0x80000000
+BENCH_PARTITION = 'user'
+BENCH_FILE_NAME = 'bench-link.bin'
+BENCH_FILE_DESTINATION = '/SD:/bench-link.bin'
+
+
+def parse_int_list(text):
+    try:
+        return [int(item, 0) for item in text.split(',') if item.strip() != '']
+    except ValueError:
+        log.die('Invalid number list: ' + text)
+
+
+def get_rtt_summary(rtt_list):
+    if len(rtt_list) == 0:
+        return None
+
+    rtt_list = sorted(rtt_list)
+    count = len(rtt_list)
+
+    return {
+        'count': count,
+        'min': rtt_list[0],
+        'mean': sum(rtt_list) / count,
+        'p50': rtt_list[count // 2],
+        'p95': rtt_list[min(count - 1, int(count * 0.95))],
+        'max': rtt_list[-1]
+    }
+
+
+def measure(phases, name, func, *args):
+    start = monotonic()
+    ret = func(*args)
+    phases[name] = monotonic() - start
+
+    return ret
+
+
+def check_sync():
+    if not sd.sync():
+        log.die('Sync failed!')
+
+
+def bench_setup(baudrate):
+    phases = {}
+
+    sd.change_host_baud(sd.SERIAL_INIT_BAUDRATE)
+    measure(phases, 'reset', sd.reset_to_download)
+    measure(phases, 'sync', check_sync)
+    measure(phases, 'change_baudrate', sd.sync_baud, baudrate)
+    measure(phases, 'sync_baudrate', check_sync)
+    phases['total'] = sum(phases.values())
+
+    return phases
+
+
+def bench_loader(phases):
+    measure(phases, 'loader_upload', sd.start_serial_loader)
+    phases['total'] = sum(value for key, value in phases.items() if key != 'total')
+
+
+def bench_transfer(family, data_file, payload_length):
+    sd.MAX_PAYLOAD_LENGTH = payload_length
+    device = sd.get_device()
+    device.payload_length = payload_length
+    device.frame_rtt = []
+
+    start = monotonic()
+    if family == 'ram':
+        sd.send_file2mem(data_file, BENCH_RAM_ADDRESS)
+    elif family == 'partition':
+        sd.send_file2partion(data_file, BENCH_PARTITION)
+    elif family == 'sd':
+        sd.send_file2sdcard(data_file, BENCH_FILE_NAME)
+    elif family == 'file':
+        sd.cp(str(data_file), BENCH_FILE_DESTINATION)
+    seconds = monotonic() - start
+
+    rtt_list = device.frame_rtt
+    device.frame_rtt = None
+    size = data_file.stat().st_size
+
+    return {
+        'family': family,
+        'payload_length': payload_length,
+        'window': sd.get_data_window(get_data_tag(family)),
+        'bytes': size,
+        'seconds': seconds,
+        'bytes_per_second': size / seconds if seconds > 0 else 0,
+        'frame_rtt': get_rtt_summary(rtt_list)
+    }
+
+
+def get_data_tag(family):
+    return {
+        'ram': sd.RAM_DATA_TAG,
+        'partition': sd.PARTION_DATA_TAG,
+        'sd': sd.FS_DATA_TAG,
+        'file': sd.FS_FILE_DATA_TAG
+    }[family]
+
+
+def run_bench(port, baudrates, payloads, families, repeat, data_file):
+    max_payload_length = sd.MAX_PAYLOAD_LENGTH
+    runs = []
+
+    sd.init_serial_device(port)
+
+    for baudrate in baudrates:
+        for index in range(repeat):
+            log.inf('Benchmarking ' + str(baudrate) + ' baud, round ' + str(index + 1) + '/' + str(repeat))
+            run = {'baudrate': baudrate, 'round': index, 'transfers': []}
+
+            sd.MAX_PAYLOAD_LENGTH = max_payload_length
+            run['setup'] = bench_setup(baudrate)
+
+            # RAM is written through the ROM, everything else needs the loader
+            rom_families = [family for family in families if family == 'ram']
+            loader_families = [family for family in families if family != 'ram']
+
+            for family in rom_families:
+                for payload_length in payloads:
+                    run['transfers'].append(bench_transfer(family, data_file, payload_length))
+
+            if len(loader_families) > 0:
+                sd.MAX_PAYLOAD_LENGTH = max_payload_length
+                bench_loader(run['setup'])
+                for family in loader_families:
+                    for payload_length in payloads:
+                        run['transfers'].append(bench_transfer(family, data_file, payload_length))
+
+            sd.MAX_PAYLOAD_LENGTH = max_payload_length
+            sd.reboot()
+            runs.append(run)
+
+    sd.deinit_serial_device()
+
+    return runs
+
+
+def print_summary(runs):
+    for run in runs:
+        log.inf('{:>8} baud  setup {:.3f}s'.format(run['baudrate'], run['setup']['total']))
+        for transfer in run['transfers']:
+            rtt = transfer['frame_rtt']
+            rtt_text = '' if rtt is None else '  rtt p50 {:.2f}ms p95 {:.2f}ms'.format(rtt['p50'] * 1000, rtt['p95'] * 1000)
+            log.inf('    {:<10} {:>6}B frames  {:>10.1f} KiB/s{}'.format(
+                transfer['family'], transfer['payload_length'], transfer['bytes_per_second'] / 1024, rtt_text))
+
+
+def bench_link(args):
+    families = [family.strip() for family in args.families.split(',')]
+    for family in families:
+        if family not in BENCH_FAMILIES:
+            log.die('Unknown tag family: ' + family + ', supported: ' + ', '.join(BENCH_FAMILIES))
+
+    baudrates = parse_int_list(args.baudrates)
+    payloads = parse_int_list(args.payloads)
+    for payload_length in payloads:
+        if payload_length <= 0 or payload_length > sd.MAX_PAYLOAD_LENGTH:
+            log.die('Payload length must be between 1 and ' + str(sd.MAX_PAYLOAD_LENGTH))
+
+    if args.port is None and not args.emulate:
+        log.die('Please specify the serial port with --port, or use --emulate')
+
+    sd.DATA_WINDOW_SIZE = args.window
+    sd.COMPRESSION = not args.no_compression
+
+    device = None
+    port = args.port
+    if args.emulate:
+        device = emulator.Emulator(latency=args.latency, throughput=args.throughput, baud_limit=args.baud_limit)
+        port = device.start()
+        log.inf('Benchmarking the emulated device on ' + port)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_file = Path(temp_dir) / BENCH_FILE_NAME
+        if args.data is not None:
+            if not args.data.is_file():
+                log.die('open file ' + str(args.data) + ' failed!')
+            shutil.copyfile(args.data, data_file)
+        else:
+            data_file.write_bytes(os.urandom(args.size))
+        data_size = data_file.stat().st_size
+        runs = run_bench(port, baudrates, payloads, families, args.repeat, data_file)
+
+    if device is not None:
+        device.stop()
+
+    report = {
+        'version': version.__VERSION__,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'host': platform.platform(),
+        'python': platform.python_version(),
+        'port': port,
+        'emulated': args.emulate,
+        'size': data_size,
+        'data': str(args.data) if args.data is not None else 'random',
+        'compression': sd.COMPRESSION,
+        'window': args.window,
+        'runs': runs
+    }
+
+    print_summary(runs)
+
+    output = Path(args.output)
+    output.write_text(json.dumps(report, indent=2), encoding='UTF-8')
+    log.inf('Benchmark report written to ' + str(output))
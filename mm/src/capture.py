@@ -0,0 +1,197 @@
+import struct, threading
+from collections import deque
+from time import sleep, time_ns, monotonic_ns
+from pathlib import Path
+import log, emulator
+import serial_download as sd
+
+
+CAPTURE_MAGIC = b'MMCAP001'
+CAPTURE_HEADER = struct.Struct('>8sQ')      # Magic, wall clock start time in ns
+CAPTURE_RECORD = struct.Struct('>BQI')      # Kind, ns since start, data length
+
+RECORD_REQUEST        = 0x01    # Request frame without preamble
+RECORD_REQUEST_HEADER = 0x02    # Request tag, length and crc, payload not captured
+RECORD_RESPONSE       = 0x03    # Response frame without preamble
+RECORD_RESPONSE_ERROR = 0x04    # No valid response was received
+RECORD_BAUDRATE       = 0x05    # Host baud rate changed, uint32
+RECORD_RESET          = 0x06    # Board reset to download mode
+
+
+class Capture:
+    '''Writes every frame on the wire with a monotonic timestamp.
+
+    Data frame payloads are dropped unless ``payloads`` is set, which keeps
+    the capture of a multi-MB download small while preserving its timing.
+    '''
+
+    def __init__(self, path, payloads=False):
+        self.path = Path(path)
+        self.payloads = payloads
+        self.file = self.path.open('wb')
+        self.start = monotonic_ns()
+        self.lock = threading.Lock()
+        self.file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, time_ns()))
+
+    def record(self, kind, data = b''):
+        with self.lock:
+            self.file.write(CAPTURE_RECORD.pack(kind, monotonic_ns() - self.start, len(data)))
+            self.file.write(data)
+
+    def record_request(self, frame):
+        # frame includes the preamble. Only data frames lose their payload,
+        # replay needs the begin, end and other control requests whole
+        tag = int.from_bytes(frame[8:12], 'big') & ~sd.DATA_DEFLATE_FLAG
+        if self.payloads or tag not in sd.DATA_TAGS or len(frame) <= sd.FRAME_OVERHEAD:
+            self.record(RECORD_REQUEST, frame[8:])
+        else:
+            self.record(RECORD_REQUEST_HEADER, bytes(frame[8:16]) + bytes(frame[-4:]))
+
+    def record_response(self, response):
+        if response is None:
+            self.record(RECORD_RESPONSE_ERROR)
+        else:
+            self.record(RECORD_RESPONSE, response)
+
+    def record_baudrate(self, baudrate):
+        self.record(RECORD_BAUDRATE, baudrate.to_bytes(4, byteorder='big'))
+
+    def record_reset(self):
+        self.record(RECORD_RESET)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_capture(path):
+    data = Path(path).read_bytes()
+    if len(data) < CAPTURE_HEADER.size:
+        log.die(str(path) + ' is not a capture file')
+
+    magic, start = CAPTURE_HEADER.unpack_from(data)
+    if magic != CAPTURE_MAGIC:
+        log.die(str(path) + ' is not a capture file')
+
+    records = []
+    offset = CAPTURE_HEADER.size
+    while offset + CAPTURE_RECORD.size <= len(data):
+        kind, timestamp, length = CAPTURE_RECORD.unpack_from(data, offset)
+        offset += CAPTURE_RECORD.size
+        records.append((kind, timestamp, data[offset : offset + length]))
+        offset += length
+
+    return start, records
+
+
+def get_tag(kind, data):
+    if kind in [RECORD_REQUEST, RECORD_REQUEST_HEADER, RECORD_RESPONSE] and len(data) >= 4:
+        return int.from_bytes(data[0:4], 'big')
+
+    return None
+
+
+def get_exchanges(records):
+    # Pair every request with what the host got back and how long it took.
+    # Responses arrive in request order, also when frames are pipelined
+    exchanges = []
+    pending = deque()
+    for kind, timestamp, data in records:
+        if kind in [RECORD_REQUEST, RECORD_REQUEST_HEADER]:
+            exchange = {'tag': get_tag(kind, data), 'sent': timestamp, 'response': None, 'received': None,
+                        'length': int.from_bytes(data[4:8], 'big')}
+            exchanges.append(exchange)
+            pending.append(exchange)
+        elif kind in [RECORD_RESPONSE, RECORD_RESPONSE_ERROR] and len(pending) > 0:
+            exchange = pending.popleft()
+            exchange['response'] = data if kind == RECORD_RESPONSE else None
+            exchange['received'] = timestamp
+        elif kind == RECORD_RESET:
+            pending.clear()
+
+    return exchanges
+
+
+class Replayer(emulator.Emulator):
+    '''Plays back the device side of a capture on a pseudo-terminal.
+
+    Pipelined requests are answered in order; each response is delayed by the
+    time the original device took, scaled by ``speed``.
+    '''
+
+    def __init__(self, records, speed=1.0):
+        super().__init__(rx_frames=16)
+        self.exchanges = [exchange for exchange in get_exchanges(records) if exchange['received'] is not None]
+        self.speed = speed
+        self.index = 0
+        self.last_received = None
+
+    def handle_frame(self, frame):
+        if self.index >= len(self.exchanges):
+            log.wrn('replay: capture exhausted, request ignored')
+            return
+
+        exchange = self.exchanges[self.index]
+        self.index += 1
+
+        tag = int.from_bytes(frame[0:4], 'big')
+        if tag != exchange['tag']:
+            log.wrn('replay: request 0x{:02x} diverges from captured 0x{:02x}'.format(tag, exchange['tag']))
+
+        # With pipelining the response time is measured from the previous
+        # response rather than from a request that was sent long before
+        start = exchange['sent']
+        if self.last_received is not None and self.last_received > start:
+            start = self.last_received
+        self.last_received = exchange['received']
+        delay = (exchange['received'] - start) / 1e9 / self.speed
+        if delay > 0:
+            sleep(delay)
+
+        if exchange['response'] is not None:
+            self.write(sd.FRAME_PREAMBLE + exchange['response'])
+
+
+def print_summary(path):
+    start, records = read_capture(path)
+    exchanges = get_exchanges(records)
+
+    duration = records[-1][1] / 1e9 if len(records) > 0 else 0
+    log.inf('Capture ' + str(path) + ': ' + str(len(records)) + ' records, ' + '{:.3f}s'.format(duration))
+
+    for kind, timestamp, data in records:
+        if kind == RECORD_BAUDRATE:
+            log.inf('  {:10.6f}s baudrate {}'.format(timestamp / 1e9, int.from_bytes(data, 'big')))
+        elif kind == RECORD_RESET:
+            log.inf('  {:10.6f}s reset'.format(timestamp / 1e9))
+
+    tags = {}
+    for exchange in exchanges:
+        item = tags.setdefault(exchange['tag'], {'count': 0, 'bytes': 0, 'errors': 0, 'rtt': []})
+        item['count'] += 1
+        item['bytes'] += exchange['length']
+        if exchange['response'] is None:
+            item['errors'] += 1
+        if exchange['received'] is not None:
+            item['rtt'].append((exchange['received'] - exchange['sent']) / 1e6)
+
+    for tag, item in sorted(tags.items()):
+        rtt = sorted(item['rtt'])
+        rtt_text = ''
+        if len(rtt) > 0:
+            rtt_text = '  rtt p50 {:.2f}ms max {:.2f}ms'.format(rtt[len(rtt) // 2], rtt[-1])
+        log.inf('  tag 0x{:02x}: {} requests, {} payload bytes, {} errors{}'.format(
+            tag, item['count'], item['bytes'], item['errors'], rtt_text))
+
+
+def replay(args):
+    if args.summary:
+        print_summary(args.file)
+        return
+
+    start, records = read_capture(args.file)
+    replayer = Replayer(records, speed=args.speed)
+    port = replayer.open()
+    log.inf('Replaying ' + str(len(replayer.exchanges)) + ' exchanges of ' + str(args.file) + ' on ' + port)
+    log.inf('Pass --port ' + port + ' to mm download/copy, press Ctrl-C to stop')
+    replayer.serve_forever()
@@ -0,0 +1,675 @@
+import os, sys, threading, queue, random, select, zlib
+from time import sleep, monotonic
+from zlib import crc32
+import log
+import serial_download as sd
+
+# Pseudo-terminals are POSIX only, mm still has to import this module on
+# Windows for capture and the command line
+try:
+    import termios, tty
+except ImportError:
+    termios = None
+    tty = None
+
+
+ROM_INFO = 'SwiftIOMicro ROM (emulated)'
+ROM_VERSION = (1, 0, 0)
+
+LOADER_INFO = 'SerialLoader (emulated)'
+LOADER_VERSION = (1, 0, 0)
+
+STATUS_OK          = 0x00
+STATUS_CRC_ERROR   = 0x01
+STATUS_UNSUPPORTED = 0x02
+STATUS_BAD_REQUEST = 0x03
+STATUS_VERIFY_FAIL = 0x04
+
+FAULT_KINDS = ['crc', 'drop', 'nak', 'noise']
+
+ROM_TAGS = [
+    sd.SYNC_TAG,
+    sd.INFO_TAG,
+    sd.VERSION_TAG,
+    sd.REBOOT_TAG,
+    sd.EXECUTE_TAG,
+    sd.CHANGE_BAUDRATE_TAG,
+    sd.RAM_BEGIN_TAG,
+    sd.RAM_DATA_TAG,
+    sd.RAM_END_TAG
+]
+
+LOADER_TAGS = ROM_TAGS + [
+    sd.PARTION_BEGIN_TAG,
+    sd.PARTION_DATA_TAG,
+    sd.PARTION_END_TAG,
+    sd.PARTION_SETBOOT_TAG,
+    sd.FS_BEGIN_TAG,
+    sd.FS_DATA_TAG,
+    sd.FS_END_TAG,
+    sd.FS_MKDIR_TAG,
+    sd.FS_RM_TAG,
+    sd.FS_FILE_BEGIN_TAG,
+    sd.FS_FILE_DATA_TAG,
+    sd.FS_FILE_END_TAG
+]
+
+# Loader extension for delta updates, see serial_download.partion_verify()
+DELTA_TAGS = [
+    sd.VERIFY_TAG,
+    sd.WRITE_TAG
+]
+
+# Loader extension for verification, see serial_download.get_remote_crcs().
+# The read requests are always there, hashing can be turned off
+VERIFY_TAGS = [
+    sd.FS_VERIFY_TAG
+]
+
+READ_TAGS = [
+    sd.READ_TAG,
+    sd.FS_READ_TAG
+]
+
+# Loader extension for batched copies, see serial_download.copy_batch()
+BATCH_TAGS = [
+    sd.FS_BATCH_BEGIN_TAG,
+    sd.FS_BATCH_DATA_TAG,
+    sd.FS_BATCH_END_TAG
+]
+
+# Loader extension for resumable transfers, see serial_download.get_transfer_position()
+RESUME_TAGS = [
+    sd.POSITION_TAG
+]
+
+PARTITION_CAPACITY = 16 * 1024 * 1024
+
+
+def get_termios_baudrates():
+    baudrates = {}
+    for name in dir(termios):
+        if name.startswith('B') and name[1:].isdigit():
+            baudrates[getattr(termios, name)] = int(name[1:])
+
+    return baudrates
+
+
+def build_frame(tag, payload = b''):
+    head = tag.to_bytes(4, byteorder='big') + len(payload).to_bytes(4, byteorder='big')
+    crc = crc32(payload, crc32(head)).to_bytes(4, byteorder='big')
+
+    return sd.FRAME_PREAMBLE + head + payload + crc
+
+
+def get_c_string(payload):
+    end = payload.find(b'\x00')
+    if end >= 0:
+        payload = payload[:end]
+
+    return bytes(payload).decode('utf-8')
+
+
+class Emulator:
+    '''Emulates the SwiftIOMicro ROM and the serial loader on a pseudo-terminal.
+
+    Frames are timestamped by a reader thread and answered by a worker thread,
+    so device processing (``latency``) overlaps with the reception of the
+    following frames just like on the real board. ``rx_frames`` is the depth
+    of the device receive buffer; with ``overrun`` set, frames arriving while
+    that buffer is full are dropped instead of being flow-controlled.
+    '''
+
+    def __init__(self, latency=0.0, throughput=0, baud_limit=False, rx_frames=2, overrun=False,
+                 fault_rate=0.0, faults=None, seed=None, max_baudrate=0, delta=True, compression=True,
+                 max_payload=0, resume=True, verify=True, batch=True, stock=False):
+        if termios is None:
+            log.die('Emulating a board needs pseudo-terminals, which this system does not have')
+
+        self.latency = latency
+        self.throughput = throughput
+        self.baud_limit = baud_limit
+        self.overrun = overrun
+        self.fault_rate = fault_rate
+        self.max_baudrate = max_baudrate
+        self.delta = delta
+        self.compression = compression
+        self.max_payload = max_payload
+        self.resume = resume
+        self.verify = verify
+        self.batch = batch
+        self.stock = stock
+        self.rx_frames = max(rx_frames, 1)
+        self.faults = faults if faults else FAULT_KINDS
+        self.random = random.Random(seed)
+
+        self.frames = queue.Queue(maxsize=self.rx_frames)
+        self.baudrates = get_termios_baudrates()
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.running = False
+        self.threads = []
+        self.write_lock = threading.Lock()
+
+        self.mode = 'rom'
+        self.loader_crc = 0
+        self.baudrate = sd.SERIAL_INIT_BAUDRATE
+        self.ram = {}
+        self.partitions = {}
+        self.boot_partition = None
+        self.files = {}
+        self.dirs = set()
+        self.transfer = None
+        self.fault = None
+        self.overrun_lost = False
+        self.stats = {'frames': 0, 'bytes': 0, 'faults': 0, 'crc_errors': 0}
+
+    def open(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        return self.port
+
+    def start(self):
+        if self.master is None:
+            self.open()
+
+        self.running = True
+        self.threads = [
+            threading.Thread(target=self.receive_loop, daemon=True),
+            threading.Thread(target=self.process_loop, daemon=True)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+        return self.port
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join(1)
+        for fd in [self.master, self.slave]:
+            if fd is not None:
+                os.close(fd)
+        self.master = None
+        self.slave = None
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while self.running:
+                sleep(0.5)
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def get_host_baudrate(self):
+        speed = termios.tcgetattr(self.master)[5]
+
+        return self.baudrates.get(speed, self.baudrate)
+
+    def get_link_rate(self):
+        # Bytes per second on the emulated wire, 0 means unlimited
+        rate = self.throughput
+        if self.baud_limit:
+            baud_rate = self.get_host_baudrate() / 10
+            if rate == 0 or baud_rate < rate:
+                rate = baud_rate
+
+        return rate
+
+    def write(self, data):
+        with self.write_lock:
+            view = memoryview(data)
+            while len(view) > 0:
+                try:
+                    written = os.write(self.master, view)
+                except BlockingIOError:
+                    select.select([], [self.master], [], 0.1)
+                    continue
+                view = view[written:]
+
+    def receive_loop(self):
+        buffer = bytearray()
+        arrival = monotonic()
+
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                data = os.read(self.master, 1 << 16)
+            except OSError:
+                break
+            buffer += data
+
+            while True:
+                start = buffer.find(sd.FRAME_PREAMBLE)
+                if start < 0:
+                    del buffer[:-len(sd.FRAME_PREAMBLE)]
+                    break
+                if start > 0:
+                    del buffer[:start]
+                if len(buffer) < 16:
+                    break
+                length = int.from_bytes(buffer[12:16], 'big')
+                frame_length = 16 + length + 4
+                if len(buffer) < frame_length:
+                    break
+
+                frame = bytes(buffer[8:frame_length])
+                frame_length -= len(sd.FRAME_PREAMBLE)
+                del buffer[:frame_length]
+
+                # The rate the host sent the frame at, see process_loop()
+                baudrate = self.get_host_baudrate()
+                rate = self.get_link_rate()
+                now = monotonic()
+                if rate > 0:
+                    arrival = max(now, arrival) + (frame_length + len(sd.FRAME_PREAMBLE)) / rate
+                else:
+                    arrival = now
+
+                if self.overrun:
+                    try:
+                        self.frames.put_nowait((arrival, baudrate, frame))
+                    except queue.Full:
+                        log.dbg('emulator: receive buffer overrun, frame dropped')
+                        self.overrun_lost = True
+                else:
+                    self.frames.put((arrival, baudrate, frame))
+
+    def process_loop(self):
+        while self.running:
+            try:
+                arrival, baudrate, frame = self.frames.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            delay = arrival + self.latency - monotonic()
+            if delay > 0:
+                sleep(delay)
+
+            if self.overrun_lost and self.mode == 'loader' and self.resume and self.transfer is not None:
+                # The loader noticed its buffer overflowed
+                self.overrun_lost = False
+                self.transfer['stalled'] = True
+
+            if baudrate != self.baudrate:
+                if baudrate != sd.SERIAL_INIT_BAUDRATE:
+                    log.dbg('emulator: frame sent at ' + str(baudrate) + ' baud to a device at ' + str(self.baudrate) + ', dropped')
+                    continue
+                # The host went back to the initial rate for a reset, which a
+                # pty cannot signal
+                self.reset()
+
+            self.handle_frame(frame)
+
+    def respond(self, tag, status = STATUS_OK, payload = b''):
+        response_tag = (0x80 << 24) | (status << 16) | (tag & 0xFF)
+        frame = build_frame(response_tag, payload)
+
+        # An adapter that cannot keep up garbles everything above its limit
+        if self.max_baudrate > 0 and self.get_host_baudrate() > self.max_baudrate:
+            frame = frame[:-1] + bytes([frame[-1] ^ 0xFF])
+
+        # A 'nak' fault already dropped the frame, see handle_frame()
+        fault = self.fault
+        self.fault = None
+        if fault is not None and fault != 'nak':
+            if fault == 'drop':
+                return
+            elif fault == 'crc':
+                frame = frame[:-1] + bytes([frame[-1] ^ 0xFF])
+            elif fault == 'noise':
+                frame = bytes(self.random.randrange(256) for i in range(7)) + frame
+
+        self.write(frame)
+
+    def handle_frame(self, frame):
+        tag = int.from_bytes(frame[0:4], 'big')
+        payload = frame[8:-4]
+        crc = int.from_bytes(frame[-4:], 'big')
+
+        self.stats['frames'] += 1
+        self.stats['bytes'] += len(frame) + len(sd.FRAME_PREAMBLE)
+
+        if crc32(frame[:-4]) != crc:
+            self.stats['crc_errors'] += 1
+            self.reject_frame(tag)
+            return
+
+        if tag & sd.DATA_DEFLATE_FLAG:
+            tag &= ~sd.DATA_DEFLATE_FLAG
+            if self.mode != 'loader' or not self.compression or tag not in sd.COMPRESSION_TAGS:
+                self.respond(tag, STATUS_UNSUPPORTED)
+                return
+            try:
+                payload = zlib.decompress(payload, -15)
+            except zlib.error:
+                self.respond(tag, STATUS_BAD_REQUEST)
+                return
+
+        if tag in sd.DATA_TAGS and self.fault_rate > 0 and self.random.random() < self.fault_rate:
+            self.fault = self.random.choice(self.faults)
+            self.stats['faults'] += 1
+            log.dbg('emulator: injecting ' + self.fault + ' fault')
+            if self.fault == 'nak':
+                # Corrupted on its way in
+                self.reject_frame(tag)
+                return
+
+        if tag not in self.get_supported_tags():
+            self.respond(tag, STATUS_UNSUPPORTED)
+            return
+
+        # The loader frame buffer, the ROM takes whatever the host sends
+        if self.mode == 'loader' and self.max_payload > 0 and int.from_bytes(frame[4:8], 'big') > self.max_payload:
+            self.respond(tag, STATUS_BAD_REQUEST)
+            return
+
+        try:
+            status, response = self.handle_tag(tag, payload)
+        except (ValueError, IndexError, UnicodeDecodeError):
+            status, response = STATUS_BAD_REQUEST, b''
+
+        self.respond(tag, status, response)
+
+        if tag == sd.CHANGE_BAUDRATE_TAG and status == STATUS_OK:
+            self.baudrate = int.from_bytes(payload[0:4], 'big')
+
+        if tag == sd.REBOOT_TAG:
+            # The next session starts with reset_to_download, which a pty
+            # cannot signal, so come back up in ROM download mode
+            self.reset()
+
+    def reset(self):
+        self.mode = 'rom'
+        self.baudrate = sd.SERIAL_INIT_BAUDRATE
+        self.transfer = None
+
+    def get_supported_tags(self):
+        if self.mode == 'rom':
+            return ROM_TAGS
+        if self.stock:
+            return LOADER_TAGS
+
+        tags = LOADER_TAGS + READ_TAGS
+        if self.delta:
+            tags = tags + DELTA_TAGS
+        if self.verify:
+            tags = tags + VERIFY_TAGS
+        if self.batch:
+            tags = tags + BATCH_TAGS
+        if self.resume:
+            tags = tags + RESUME_TAGS
+
+        return tags
+
+    def reject_frame(self, tag):
+        # A resumable loader drops the data frames behind a lost one until the
+        # host asks where to go on from
+        if self.mode == 'loader' and self.resume and self.transfer is not None:
+            self.transfer['stalled'] = True
+        self.respond(tag, STATUS_CRC_ERROR)
+
+    def begin_transfer(self, kind, target, length):
+        self.transfer = {'kind': kind, 'target': target, 'length': length, 'data': bytearray()}
+
+        return STATUS_OK, b''
+
+    def data_transfer(self, kind, payload):
+        if self.transfer is None or self.transfer['kind'] != kind or self.transfer.get('stalled'):
+            return STATUS_BAD_REQUEST, b''
+        if len(self.transfer['data']) + len(payload) > self.transfer['length']:
+            return STATUS_BAD_REQUEST, b''
+
+        self.transfer['data'] += payload
+
+        return STATUS_OK, b''
+
+    def end_transfer(self, kind, payload):
+        transfer = self.transfer
+        self.transfer = None
+        if transfer is None or transfer['kind'] != kind:
+            return STATUS_BAD_REQUEST, None
+
+        data = bytes(transfer['data'])
+        if len(data) != transfer['length'] or crc32(data) != int.from_bytes(payload[0:4], 'big'):
+            return STATUS_VERIFY_FAIL, None
+
+        return STATUS_OK, (transfer['target'], data)
+
+    def unpack_batch(self, stream):
+        entries = []
+        offset = 0
+        while offset < len(stream):
+            if offset + sd.BATCH_RECORD.size > len(stream):
+                return False
+            kind, path_length, data_length = sd.BATCH_RECORD.unpack_from(stream, offset)
+            offset += sd.BATCH_RECORD.size
+            if kind not in [sd.BATCH_DIR, sd.BATCH_FILE] or offset + path_length + data_length > len(stream):
+                return False
+            path = stream[offset : offset + path_length].decode('utf-8')
+            offset += path_length
+            entries.append((kind, path, stream[offset : offset + data_length]))
+            offset += data_length
+
+        for kind, path, data in entries:
+            if kind == sd.BATCH_DIR:
+                self.dirs.add(path)
+            else:
+                self.files[path] = data
+
+        return True
+
+    def read_partition(self, name, offset, length):
+        # Erased flash reads back as 0xFF
+        data = bytes(self.partitions.get(name, b'')[offset : offset + length])
+
+        return data + b'\xff' * (length - len(data))
+
+    def handle_tag(self, tag, payload):
+        if tag == sd.SYNC_TAG:
+            return STATUS_OK, b''
+
+        if tag == sd.INFO_TAG:
+            if self.mode == 'rom':
+                return STATUS_OK, ROM_INFO.encode('utf-8')
+            if self.stock:
+                return STATUS_OK, LOADER_INFO.encode('utf-8')
+            features = []
+            if self.compression:
+                features.append('deflate')
+            if self.delta:
+                features.append('delta')
+            if self.resume:
+                features.append('resume')
+            if self.batch:
+                features.append('batch')
+            tags = self.get_supported_tags()
+            info = LOADER_INFO + '; features=' + ','.join(features) + '; loader_crc={:08x}'.format(self.loader_crc)
+            info += '; max_payload=' + str(self.max_payload if self.max_payload > 0 else sd.MAX_PAYLOAD_LENGTH)
+            info += '; rx_frames=' + str(self.rx_frames)
+            info += '; tags=' + ','.join('{:02x}'.format(tag) for tag in tags)
+            return STATUS_OK, info.encode('utf-8')
+
+        if tag == sd.VERSION_TAG:
+            version = ROM_VERSION if self.mode == 'rom' else LOADER_VERSION
+            return STATUS_OK, bytes([0]) + bytes(version)
+
+        if tag == sd.CHANGE_BAUDRATE_TAG:
+            return STATUS_OK, b''
+
+        if tag == sd.POSITION_TAG:
+            if self.transfer is None:
+                return STATUS_BAD_REQUEST, b''
+            self.transfer['stalled'] = False
+            return STATUS_OK, len(self.transfer['data']).to_bytes(4, byteorder='big')
+
+        if tag == sd.REBOOT_TAG:
+            return STATUS_OK, b''
+
+        if tag == sd.EXECUTE_TAG:
+            address = int.from_bytes(payload[0:8], 'big')
+            if address not in self.ram:
+                return STATUS_BAD_REQUEST, b''
+            self.loader_crc = crc32(self.ram[address])
+            self.mode = 'loader'
+            return STATUS_OK, b''
+
+        if tag == sd.RAM_BEGIN_TAG:
+            address = int.from_bytes(payload[0:8], 'big')
+            length = int.from_bytes(payload[8:12], 'big')
+            return self.begin_transfer('ram', address, length)
+
+        if tag == sd.PARTION_BEGIN_TAG:
+            name = get_c_string(payload[0:64])
+            length = int.from_bytes(payload[64:68], 'big')
+            return self.begin_transfer('partition', name, length)
+
+        if tag in [sd.FS_BEGIN_TAG, sd.FS_FILE_BEGIN_TAG]:
+            length = int.from_bytes(payload[0:4], 'big')
+            path = get_c_string(payload[4:])
+            return self.begin_transfer('file', path, length)
+
+        if tag == sd.RAM_DATA_TAG:
+            return self.data_transfer('ram', payload)
+
+        if tag == sd.PARTION_DATA_TAG:
+            return self.data_transfer('partition', payload)
+
+        if tag in [sd.FS_DATA_TAG, sd.FS_FILE_DATA_TAG]:
+            return self.data_transfer('file', payload)
+
+        if tag == sd.FS_BATCH_BEGIN_TAG:
+            return self.begin_transfer('batch', None, int.from_bytes(payload[0:4], 'big'))
+
+        if tag == sd.FS_BATCH_DATA_TAG:
+            return self.data_transfer('batch', payload)
+
+        if tag == sd.FS_BATCH_END_TAG:
+            status, result = self.end_transfer('batch', payload)
+            if status == STATUS_OK and not self.unpack_batch(result[1]):
+                status = STATUS_BAD_REQUEST
+            return status, b''
+
+        if tag in [sd.RAM_END_TAG, sd.PARTION_END_TAG, sd.FS_END_TAG, sd.FS_FILE_END_TAG]:
+            kind = {sd.RAM_END_TAG: 'ram', sd.PARTION_END_TAG: 'partition'}.get(tag, 'file')
+            status, result = self.end_transfer(kind, payload)
+            if status == STATUS_OK:
+                target, data = result
+                if kind == 'ram':
+                    self.ram[target] = data
+                elif kind == 'partition':
+                    self.partitions[target] = bytearray(data)
+                else:
+                    self.files[target] = data
+            return status, b''
+
+        if tag == sd.PARTION_SETBOOT_TAG:
+            name = get_c_string(payload[0:64])
+            if name not in self.partitions:
+                return STATUS_BAD_REQUEST, b''
+            self.boot_partition = name
+            return STATUS_OK, b''
+
+        if tag == sd.VERIFY_TAG:
+            name = get_c_string(payload[0:64])
+            offset = int.from_bytes(payload[64:68], 'big')
+            length = int.from_bytes(payload[68:72], 'big')
+            block_size = int.from_bytes(payload[72:76], 'big')
+            if block_size == 0 or offset + length > PARTITION_CAPACITY:
+                return STATUS_BAD_REQUEST, b''
+            data = self.read_partition(name, offset, length)
+            block_crcs = b''
+            for start in range(0, length, block_size):
+                block_crcs += crc32(data[start : start + block_size]).to_bytes(4, byteorder='big')
+            return STATUS_OK, block_crcs
+
+        if tag == sd.READ_TAG:
+            name = get_c_string(payload[0:64])
+            offset = int.from_bytes(payload[64:68], 'big')
+            length = int.from_bytes(payload[68:72], 'big')
+            if offset + length > PARTITION_CAPACITY:
+                return STATUS_BAD_REQUEST, b''
+            return STATUS_OK, self.read_partition(name, offset, length)
+
+        if tag in [sd.FS_VERIFY_TAG, sd.FS_READ_TAG]:
+            offset = int.from_bytes(payload[0:4], 'big')
+            length = int.from_bytes(payload[4:8], 'big')
+            if tag == sd.FS_VERIFY_TAG:
+                block_size = int.from_bytes(payload[8:12], 'big')
+                path = get_c_string(payload[12:])
+                if block_size == 0:
+                    return STATUS_BAD_REQUEST, b''
+            else:
+                path = get_c_string(payload[8:])
+            data = self.files.get(path, b'')
+            response = len(data).to_bytes(4, byteorder='big')
+            data = data[offset : offset + length]
+            if tag == sd.FS_READ_TAG:
+                return STATUS_OK, response + data
+            for start in range(0, len(data), block_size):
+                response += crc32(data[start : start + block_size]).to_bytes(4, byteorder='big')
+            return STATUS_OK, response
+
+        if tag == sd.WRITE_TAG:
+            name = get_c_string(payload[0:64])
+            offset = int.from_bytes(payload[64:68], 'big')
+            data = payload[68:]
+            if offset + len(data) > PARTITION_CAPACITY:
+                return STATUS_BAD_REQUEST, b''
+            partition = self.partitions.setdefault(name, bytearray())
+            if len(partition) < offset + len(data):
+                partition.extend(b'\xff' * (offset + len(data) - len(partition)))
+            partition[offset : offset + len(data)] = data
+            return STATUS_OK, b''
+
+        if tag == sd.FS_MKDIR_TAG:
+            self.dirs.add(get_c_string(payload))
+            return STATUS_OK, b''
+
+        if tag == sd.FS_RM_TAG:
+            path = get_c_string(payload)
+            prefix = path.rstrip('/') + '/'
+            for name in [name for name in self.files if name == path or name.startswith(prefix)]:
+                del self.files[name]
+            self.dirs = set(name for name in self.dirs if name != path and not name.startswith(prefix))
+            return STATUS_OK, b''
+
+        return STATUS_UNSUPPORTED, b''
+
+
+def run(args):
+    if sys.platform.startswith('win'):
+        log.die('The device emulator requires a POSIX pseudo-terminal')
+
+    faults = None
+    if args.faults:
+        faults = [fault.strip() for fault in args.faults.split(',')]
+        for fault in faults:
+            if fault not in FAULT_KINDS:
+                log.die('Unknown fault kind: ' + fault + ', supported: ' + ', '.join(FAULT_KINDS))
+
+    emulator = Emulator(latency=args.latency, throughput=args.throughput, baud_limit=args.baud_limit,
+                        rx_frames=args.rx_frames, overrun=args.overrun,
+                        fault_rate=args.fault_rate, faults=faults, seed=args.seed,
+                        max_baudrate=args.max_baudrate, delta=not args.no_delta,
+                        compression=not args.no_compression, max_payload=args.max_payload,
+                        resume=not args.no_resume, verify=not args.no_verify,
+                        batch=not args.no_batch, stock=args.stock)
+    port = emulator.open()
+    log.inf('Emulated SwiftIOMicro listening on ' + port)
+    log.inf('Pass --port ' + port + ' to mm download/copy, press Ctrl-C to stop')
+    emulator.serve_forever()
+
+    log.inf('Frames: ' + str(emulator.stats['frames']) + ', bytes: ' + str(emulator.stats['bytes']) +
+            ', injected faults: ' + str(emulator.stats['faults']))
+    for name, data in emulator.partitions.items():
+        log.inf('Partition ' + name + ': ' + str(len(data)) + ' bytes')
+    for name, data in emulator.files.items():
+        log.inf('File ' + name + ': ' + str(len(data)) + ' bytes')
@@ -17,44 +17,78 @@ IMAGE_VERIFY_SHA256 = 0x02                    # SHA256
 IMAGE_VERIFY_TYPE   = IMAGE_VERIFY_SHA256
 IMAGE_VERIFY_CAPACITY = 64                  # 64 bytes capacity
 
-def create_image(bin_path, out_path, out_name, load_address=IMAGE_LOAD_ADDRESS, verify='sha256'):
-    image_name = out_name
-    image_path = out_path / image_name
+# Images are copied through one buffer of this size, whatever their size
+IMAGE_CHUNK_LENGTH = 1024 * 1024
 
-    log.inf('Creating image ' + image_name + '...')
 
-    image_raw_binary = bin_path.read_bytes()
+class Crc32:
+    '''zlib.crc32 with the update() interface of hashlib.'''
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = crc32(data, self.value)
+
 
+def copy_stream(src, dst, checksum):
+    # Copies src to dst a chunk at a time, every chunk also goes through
+    # checksum.update(). Returns the number of bytes copied
+    buffer = bytearray(IMAGE_CHUNK_LENGTH)
+    view = memoryview(buffer)
+    size = 0
+    while True:
+        count = src.readinto(buffer)
+        if not count:
+            return size
+        checksum.update(view[:count])
+        dst.write(view[:count])
+        size += count
+
+
+def get_image_header(size, load_address, verify_type, image_verify):
     image_offset = IMAGE_START_OFFSET.to_bytes(8, byteorder='little')
-    image_size = len(image_raw_binary).to_bytes(8, byteorder='little')
+    image_size = size.to_bytes(8, byteorder='little')
     image_load_address = load_address.to_bytes(8, byteorder='little')
     image_type = IMAGE_TYPE.to_bytes(4, byteorder='little')
+    image_verify_type = verify_type.to_bytes(4, byteorder='little')
+
+    image_verify = image_verify + bytes(IMAGE_VERIFY_CAPACITY - len(image_verify))
+    log.dbg('Hash value: ' + str(list(image_verify)))
+    image_header = image_offset + image_size + image_load_address + image_type + image_verify_type + image_verify
+
+    header_crc = crc32(image_header).to_bytes(4, byteorder='little')
+    image_header = header_crc + image_header
+
+    return image_header.ljust(IMAGE_HEADER_CAPACITY, b'\xff')
+
+
+def create_image(bin_path, out_path, out_name, load_address=IMAGE_LOAD_ADDRESS, verify='sha256'):
+    image_name = out_name
+    image_path = out_path / image_name
+
+    log.inf('Creating image ' + image_name + '...')
 
     if verify == 'sha256':
         verify_type = IMAGE_VERIFY_SHA256
+        checksum = hashlib.sha256()
     else:
         verify_type = IMAGE_VERIFY_CRC32
+        checksum = Crc32()
 
-    image_verify_type = verify_type.to_bytes(4, byteorder='little')
-
-    if verify_type == IMAGE_VERIFY_SHA256:
-        h = hashlib.sha256()
-        h.update(image_raw_binary)
-        image_hash = h.digest()
-        image_hash = image_hash + bytes(IMAGE_VERIFY_CAPACITY - len(image_hash))
-        log.dbg('Hash value: ' + str(list(image_hash)))
-        image_header = image_offset + image_size + image_load_address + image_type + image_verify_type + image_hash
-    else:
-        image_crc = crc32(image_raw_binary).to_bytes(4, byteorder='little')
-        image_crc = image_crc + bytes(IMAGE_VERIFY_CAPACITY - len(image_crc))
-        image_header = image_offset + image_size + image_load_address + image_type + image_verify_type + image_crc
-
-    header_crc = crc32(image_header).to_bytes(4, byteorder='little')
-    image_header = header_crc + image_header
+    # The header depends on the whole binary, its space is reserved and
+    # filled in once the binary has been copied behind it
+    with bin_path.open('rb') as src, image_path.open('wb') as dst:
+        dst.seek(IMAGE_HEADER_CAPACITY)
+        size = copy_stream(src, dst, checksum)
 
-    header_block = image_header.ljust(IMAGE_HEADER_CAPACITY, b'\xff')
+        if verify_type == IMAGE_VERIFY_SHA256:
+            image_verify = checksum.digest()
+        else:
+            image_verify = checksum.value.to_bytes(4, byteorder='little')
 
-    image_path.write_bytes(header_block + image_raw_binary)
+        dst.seek(0)
+        dst.write(get_image_header(size, load_address, verify_type, image_verify))
 
 
 def create_swiftio_bin(bin_path, out_path, out_name):
@@ -62,6 +96,7 @@ def create_swiftio_bin(bin_path, out_path, out_name):
     image_path = out_path / image_name
 
     log.inf('Creating image ' + image_name + '...')
-    image_raw_binary = bin_path.read_bytes()
-    image_crc = crc32(image_raw_binary).to_bytes(4, byteorder='little')
-    image_path.write_bytes(image_raw_binary + image_crc)
\ No newline at end of file
+    checksum = Crc32()
+    with bin_path.open('rb') as src, image_path.open('wb') as dst:
+        copy_stream(src, dst, checksum)
+        dst.write(checksum.value.to_bytes(4, byteorder='little'))
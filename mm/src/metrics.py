@@ -0,0 +1,131 @@
+import json, os, threading
+from contextlib import contextmanager
+from time import time, monotonic
+from pathlib import Path
+import log, version
+
+
+# Output files, set by --metrics-json and --metrics-prom. Both hold the
+# metrics of the last command, the Prometheus one is meant for the textfile
+# collector of node_exporter
+METRICS_JSON = None
+METRICS_PROM = None
+METRICS_PREFIX = 'mm_'
+
+RTT_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2]
+
+# Name: (type, help)
+METRIC_TYPES = {
+    'command_seconds': ('gauge', 'Duration of the last command'),
+    'phase_seconds': ('gauge', 'Duration of a phase of the last command'),
+    'first_frame_seconds': ('gauge', 'Time from the start of the last command to its first data frame'),
+    'bytes_sent': ('gauge', 'Bytes written to the serial port, frames included'),
+    'bytes_received': ('gauge', 'Bytes read from the serial port, frames included'),
+    'frame_rtt_seconds': ('histogram', 'Round-trip time of data frames'),
+    'link_errors': ('gauge', 'Failed data frames by kind, and how they were recovered'),
+    'baudrate': ('gauge', 'Baud rate the transfer ran at'),
+    'image_bytes': ('gauge', 'Size of an image built or downloaded'),
+    'exit_code': ('gauge', 'Exit code of the last command'),
+    'timestamp_seconds': ('gauge', 'Unix time the metrics were written at')
+}
+
+METRICS_LOCK = threading.Lock()
+METRICS = {}
+
+
+def is_enabled():
+    return METRICS_JSON is not None or METRICS_PROM is not None
+
+
+def record(name, value, **labels):
+    # Gauges keep the last value, histograms take a value or a list of them
+    if not is_enabled():
+        return
+
+    kind = METRIC_TYPES[name][0]
+    key = (name, tuple(sorted((label, str(text)) for label, text in labels.items())))
+    with METRICS_LOCK:
+        if kind == 'histogram':
+            entry = METRICS.setdefault(key, {'buckets': [0] * len(RTT_BUCKETS), 'sum': 0, 'count': 0})
+            for sample in value if isinstance(value, list) else [value]:
+                for index, bound in enumerate(RTT_BUCKETS):
+                    if sample <= bound:
+                        entry['buckets'][index] += 1
+                entry['sum'] += sample
+                entry['count'] += 1
+        else:
+            METRICS[key] = value
+
+
+@contextmanager
+def phase(command, name):
+    start = monotonic()
+    try:
+        yield
+    finally:
+        record('phase_seconds', monotonic() - start, command=command, phase=name)
+
+
+def get_json():
+    metrics = []
+    for (name, labels), value in sorted(METRICS.items()):
+        metrics.append({'name': METRICS_PREFIX + name, 'labels': dict(labels), 'value': value})
+
+    return {'version': version.__VERSION__, 'timestamp': time(), 'metrics': metrics}
+
+
+def get_label_text(labels, extra = None):
+    labels = list(labels) + ([extra] if extra is not None else [])
+    if len(labels) == 0:
+        return ''
+
+    text = ','.join(label + '="' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for label, value in labels)
+
+    return '{' + text + '}'
+
+
+def get_prometheus():
+    lines = []
+    for name in sorted(set(key[0] for key in METRICS)):
+        kind, help_text = METRIC_TYPES[name]
+        full_name = METRICS_PREFIX + name
+        lines.append('# HELP ' + full_name + ' ' + help_text)
+        lines.append('# TYPE ' + full_name + ' ' + kind)
+        for (entry_name, labels), value in sorted(METRICS.items()):
+            if entry_name != name:
+                continue
+            if kind != 'histogram':
+                lines.append(full_name + get_label_text(labels) + ' ' + repr(float(value)))
+                continue
+            for bound, count in zip(RTT_BUCKETS, value['buckets']):
+                lines.append(full_name + '_bucket' + get_label_text(labels, ('le', repr(float(bound)))) + ' ' + str(count))
+            lines.append(full_name + '_bucket' + get_label_text(labels, ('le', '+Inf')) + ' ' + str(value['count']))
+            lines.append(full_name + '_sum' + get_label_text(labels) + ' ' + repr(float(value['sum'])))
+            lines.append(full_name + '_count' + get_label_text(labels) + ' ' + str(value['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_file(path, text):
+    # The collector must never read a half written file
+    path = Path(path)
+    temp_path = path.with_name(path.name + '.tmp')
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path.write_text(text, encoding='UTF-8')
+        os.replace(temp_path, path)
+    except OSError as e:
+        log.wrn('cannot write metrics to ' + str(path) + ': ' + str(e))
+
+
+def write(exit_code):
+    if not is_enabled():
+        return
+
+    record('exit_code', exit_code)
+    record('timestamp_seconds', time())
+    with METRICS_LOCK:
+        if METRICS_JSON is not None:
+            write_file(METRICS_JSON, json.dumps(get_json(), indent=2))
+        if METRICS_PROM is not None:
+            write_file(METRICS_PROM, get_prometheus())
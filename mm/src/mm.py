@@ -1,10 +1,60 @@
 import os, sys, platform, argparse, shutil
 from pathlib import Path
 import log, util, spm, mmp, download, version
-import serial_download, image
+import serial_download, image, emulator, bench, capture, session, metrics
 import multiprocessing
 
 PROJECT_PATH = ''
+SERIAL_NAME = None
+SERIAL_ALL = False
+
+
+def get_serial_name(default):
+    if SERIAL_NAME is not None:
+        return SERIAL_NAME
+
+    return default
+
+
+def get_serial_ports(serial_name):
+    # Several boards are flashed with --all or a comma separated --port list
+    if ',' in serial_name:
+        return [name.strip() for name in serial_name.split(',') if name.strip() != '']
+
+    if SERIAL_ALL:
+        if serial_download.SERIAL_NUMBER is not None:
+            log.die('--serial selects a single board, it cannot be combined with --all')
+        ports = serial_download.find_serial_device(serial_name, bridges = True)
+        if ports is None:
+            log.die('Please confirm ' + serial_name + ' is correctly connected to your computer!')
+        return ports
+
+    return None
+
+
+def print_device_results(results):
+    failed = 0
+    for result in results:
+        if result['ok']:
+            errors = ', '.join(name + ' ' + str(count) for name, count in sorted(result['link_errors'].items()))
+            log.inf('{:<24} done    {:6.1f}s  {} baud{}'.format(result['port'], result['seconds'], result['baudrate'], '  link errors: ' + errors if errors else ''))
+        else:
+            failed += 1
+            log.err('{:<24} failed  {:6.1f}s  {}'.format(result['port'], result['seconds'], result['error']), prefix=False)
+
+    if failed > 0:
+        log.die(str(failed) + ' of ' + str(len(results)) + ' boards failed')
+
+
+def call_serial(function, serial_name, *args):
+    ports = get_serial_ports(serial_name)
+    if ports is None:
+        session.call(function, serial_name, *args)
+        return
+
+    log.inf('Flashing ' + str(len(ports)) + ' boards: ' + ', '.join(ports))
+    results = serial_download.load_to_devices(ports, getattr(serial_download, function), *args)
+    print_device_results(results)
 
 def init_project(args):
     mmp_manifest = Path(PROJECT_PATH / 'Package.mmp')
@@ -52,18 +102,42 @@ def init_project(args):
 #             log.die('Board name is not specified')
 
 def build_with_sdk(build_path, p_type, p_name):
-    spm.build(p_path=PROJECT_PATH, p_type=p_type)
+    try:
+        with metrics.phase('build', 'swift build'):
+            spm.build(p_path=PROJECT_PATH, p_type=p_type)
+    except SystemExit:
+        # A failed build must not leave the previous image to be downloaded
+        mmp.clean(p_path=PROJECT_PATH)
+        raise
+
+    if p_type != 'executable' or not (build_path / p_name).exists():
+        mmp.clean(p_path=PROJECT_PATH)
+        return
+
+    image_name = mmp.get_board_info('sd_image_name')
+    board_name = mmp.get_board_name()
+    bin_path = build_path / (p_name + '.bin')
+    outputs = [bin_path, build_path / image_name]
 
-    if p_type == 'executable' and (build_path / p_name).exists():
-        bin_path = mmp.create_binary(build_path=build_path, name=p_name)
-        image_name = mmp.get_board_info('sd_image_name')
-        board_name = mmp.get_board_name()
-        if board_name == 'SwiftIOMicro':
-            image.create_image(bin_path, build_path, image_name)
-        elif board_name == 'SwiftIOBoard':
-            image.create_swiftio_bin(bin_path, build_path, image_name)
-        else:
-            log.die('Board name is not specified') 
+    with metrics.phase('build', 'image key'):
+        key = mmp.get_image_key(build_path / p_name, board_name, image_name)
+    if mmp.is_image_current(build_path, p_name, key, outputs):
+        log.inf(p_name + ' is unchanged, reusing ' + image_name)
+    else:
+        mmp.clean(p_path=PROJECT_PATH)
+        with metrics.phase('build', 'objcopy'):
+            bin_path = mmp.create_binary(build_path=build_path, name=p_name)
+        with metrics.phase('build', 'image'):
+            if board_name == 'SwiftIOMicro':
+                image.create_image(bin_path, build_path, image_name)
+            elif board_name == 'SwiftIOBoard':
+                image.create_swiftio_bin(bin_path, build_path, image_name)
+            else:
+                log.die('Board name is not specified') 
+        mmp.save_image_stamp(build_path, p_name, key, outputs)
+
+    for path in [build_path / p_name, bin_path, build_path / image_name]:
+        metrics.record('image_bytes', path.stat().st_size, command='build', image=path.name)
 
 # def build_project(args):
 #     mmp_manifest = Path(PROJECT_PATH / 'Package.mmp')
@@ -103,7 +177,6 @@ def build_project(args):
     mmp_content = mmp_manifest.read_text()
     mmp.initialize(mmp_content)
 
-    mmp.clean(p_path=PROJECT_PATH)
     spm.initialize()
     p_name = spm.get_project_name()
     p_type = spm.get_project_type()
@@ -121,7 +194,7 @@ def build_project(args):
     log.inf('Done!')
 
 
-def download_project_to_partition(partition):
+def download_project_to_partition(partition, function = 'load_to_partition'):
     mmp_manifest = Path(PROJECT_PATH / 'Package.mmp')
 
     if not mmp_manifest.is_file():
@@ -144,15 +217,15 @@ def download_project_to_partition(partition):
     if not image.is_file():
         log.die('Cannot find ' + file_name)
 
-    serial_name = mmp.get_board_info('usb2serial_device')
+    serial_name = get_serial_name(mmp.get_board_info('usb2serial_device'))
 
     if board_name == 'SwiftIOMicro':
-        serial_download.load_to_partition(serial_name, image, partition)
+        call_serial(function, serial_name, image, partition)
 
     log.inf('Done!')
 
 
-def download_project_to_sd():
+def download_project_to_sd(function = 'load_to_sdcard'):
     mmp_manifest = Path(PROJECT_PATH / 'Package.mmp')
 
     if not mmp_manifest.is_file():
@@ -176,10 +249,10 @@ def download_project_to_sd():
     if not image.is_file():
         log.die('Cannot find ' + file_name)
     
-    serial_name = mmp.get_board_info('usb2serial_device')
+    serial_name = get_serial_name(mmp.get_board_info('usb2serial_device'))
 
     if board_name == 'SwiftIOMicro':
-        serial_download.load_to_sdcard(serial_name, image, file_name)
+        call_serial(function, serial_name, image, file_name)
     elif board_name == 'SwiftIOBoard':
         download.darwin_download(source=image)
 
@@ -187,7 +260,14 @@ def download_project_to_sd():
 
 
 def download_to_sd_with_target_name(serial_name, image, file_name):
-        serial_download.load_to_sdcard(serial_name, image, file_name)
+        call_serial('load_to_sdcard', serial_name, image, file_name)
+
+
+def get_sd_target_name(path):
+    if path.suffix == '':
+        return path.stem
+
+    return path.name
 
 
 def download_to_sd(args):
@@ -198,13 +278,7 @@ def download_to_sd(args):
     if not f.is_file():
         log.die('open file ' + str(f) + ' failed!')
 
-    path = Path(f)
-    if path.suffix == '':
-        file_name = path.stem
-    else:
-        file_name = path.name
-
-    download_to_sd_with_target_name('wch', f, file_name)
+    download_to_sd_with_target_name(get_serial_name('wch'), f, get_sd_target_name(Path(f)))
 
 def download_to_partition(args):
     if args.file is None or args.partition is None:
@@ -214,7 +288,7 @@ def download_to_partition(args):
     if not f.is_file():
         log.die('open file ' + str(f) + ' failed!')
 
-    serial_download.load_to_partition('wch', f, args.partition)
+    call_serial('load_to_partition', get_serial_name('wch'), f, args.partition)
 
 def download_to_ram(args):
     if args.file is None or args.address is None:
@@ -227,10 +301,19 @@ def download_to_ram(args):
     if not f.is_file():
         log.die('open file ' + str(f) + ' failed!')
     
-    serial_download.load_to_ram('wch', f, address)
+    call_serial('load_to_ram', get_serial_name('wch'), f, address)
 
 
 def download_img(args):
+    serial_download.DATA_WINDOW_SIZE = args.window
+    serial_download.TARGET_BAUDRATE = args.baudrate
+    serial_download.DELTA_UPDATE = args.delta
+    serial_download.COMPRESSION = not args.no_compression
+    serial_download.KEEP_LOADER = args.keep_loader
+    serial_download.TIMING = args.timing
+    serial_download.SKIP_IDENTICAL = args.skip_if_identical
+    session.USE_SESSION = not args.no_session
+
     if args.type == 'sd':
         if args.file is None:
             download_project_to_sd()
@@ -245,6 +328,30 @@ def download_img(args):
         download_to_ram(args)
 
 
+def verify_img(args):
+    serial_download.TARGET_BAUDRATE = args.baudrate
+    serial_download.TIMING = args.timing
+    session.USE_SESSION = not args.no_session
+
+    if args.type == 'sd':
+        if args.file is None:
+            download_project_to_sd('verify_sdcard')
+            return
+        function = 'verify_sdcard'
+        target = get_sd_target_name(args.file)
+    else:
+        if args.file is None:
+            download_project_to_partition(args.partition, 'verify_partition')
+            return
+        function = 'verify_partition'
+        target = args.partition
+
+    if not args.file.is_file():
+        log.die('open file ' + str(args.file) + ' failed!')
+
+    call_serial(function, get_serial_name('wch'), args.file, target)
+
+
 def copy_resources(args):
     source = Path(args.source)
     destination = Path(args.destination)
@@ -274,7 +381,16 @@ def copy_resources(args):
     else:
         delete_first = False
 
-    serial_download.copy_to_filesystem('wch', delete_first, source, destination, files)
+    serial_download.DATA_WINDOW_SIZE = args.window
+    serial_download.TARGET_BAUDRATE = args.baudrate
+    serial_download.COMPRESSION = not args.no_compression
+    serial_download.BATCH_COPY = not args.no_batch
+    serial_download.INCREMENTAL_COPY = not args.full
+    serial_download.TRUST_LOCAL_MANIFEST = args.trust_local_manifest
+    serial_download.KEEP_LOADER = args.keep_loader
+    serial_download.TIMING = args.timing
+    session.USE_SESSION = not args.no_session
+    call_serial('copy_to_filesystem', get_serial_name('wch'), delete_first, source, destination, files, PROJECT_PATH / '.build' / 'resources.json')
 
     for file in files:
         log.dbg(str(file))
@@ -403,6 +519,16 @@ def clean_project(args):
     if args.deep:
         spm.clean()
 
+def list_boards(args):
+    boards = [port for port in serial_download.get_serial_ports() if serial_download.is_usb_bridge(port)]
+    if len(boards) == 0:
+        log.inf('No board found')
+        return
+
+    for port in boards:
+        log.inf('{:<24} {:<24} {:04x}:{:04x}  {}'.format(port.device, str(port.serial_number), port.vid, port.pid, port.description))
+
+
 def get_info(args):
     if args.info == 'usb':
         mmp_manifest = Path(PROJECT_PATH / 'Package.mmp')
@@ -429,6 +555,8 @@ def get_info(args):
 
 def main():
     global PROJECT_PATH
+    global SERIAL_NAME
+    global SERIAL_ALL
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--version', action = 'store_true', help = "Show the MadMachine SDK version")
@@ -443,6 +571,8 @@ def main():
     init_parser.set_defaults(func = init_project)
 
     build_parser = subparsers.add_parser('build', help = 'Build a project')
+    build_parser.add_argument('--metrics-json', type = Path, default = None, help = "Write the durations and image sizes of the build to a JSON file")
+    build_parser.add_argument('--metrics-prom', type = Path, default = None, help = "Write the durations and image sizes of the build to a Prometheus textfile collector file")
     build_parser.add_argument('-v', '--verbose', action = 'store_true', help = "Increase the verbosity of the output")
     build_parser.set_defaults(func = build_project)
 
@@ -458,16 +588,118 @@ def main():
     download_parser.add_argument('-p', '--partition', type = str, default = 'user', help = "Target flash partition, the default is 'user'")
     download_parser.add_argument('-a', '--address', type = str, default = '0x80000000', help = "Target RAM address")
     download_parser.add_argument('-f', '--file', type = Path, default = None, help = "Path to the image file")
+    download_parser.add_argument('-w', '--window', type = int, choices = range(1, 17), metavar = '[1-16]', default = serial_download.DATA_WINDOW_SIZE, help = "Number of data frames in flight, 1 means stop-and-wait")
+    download_parser.add_argument('--delta', action = 'store_true', help = "Only send the changed blocks of a partition image, if the serial loader supports it")
+    download_parser.add_argument('--no-compression', action = 'store_true', help = "Always send raw data frames, even if the serial loader supports compression")
+    download_parser.add_argument('--keep-loader', action = 'store_true', help = "Leave the serial loader running instead of rebooting, so the next download/copy can reuse it")
+    download_parser.add_argument('-b', '--baudrate', type = int, default = None, help = "Transfer baud rate, the fastest reliable rate is negotiated by default")
+    download_parser.add_argument('--skip-if-identical', action = 'store_true', help = "Read back the partition or SD file first and skip the download if it already holds the image")
+    download_parser.add_argument('--timing', action = 'store_true', help = "Print how long each phase of the download took")
+    download_parser.add_argument('--metrics-json', type = Path, default = None, help = "Write phase durations, bytes, frame round-trip times, link errors and the baud rate to a JSON file")
+    download_parser.add_argument('--metrics-prom', type = Path, default = None, help = "Write the same metrics to a Prometheus textfile collector file")
+    download_parser.add_argument('--capture', type = Path, default = None, help = "Record every frame on the wire to a capture file")
+    download_parser.add_argument('--capture-payloads', action = 'store_true', help = "Include data frame payloads in the capture")
+    download_parser.add_argument('--no-session', action = 'store_true', help = "Talk to the board directly even if 'mm session' is running")
+    download_parser.add_argument('--port', type = str, default = None, help = "Serial port of the board, e.g. the pty of 'mm emulate', a comma separated list flashes all of them in parallel")
+    download_parser.add_argument('--serial', type = str, default = None, help = "USB serial number of the board to use, see 'mm boards'")
+    download_parser.add_argument('--all', action = 'store_true', help = "Flash every attached board in parallel")
     download_parser.add_argument('-v', '--verbose', action = 'store_true', help = "Increase the verbosity of the output")
     download_parser.set_defaults(func = download_img)
 
+    verify_parser = subparsers.add_parser('verify', help = 'Compare the image on the board\'s Flash partition or SD card with the local one')
+    verify_parser.add_argument('-t', '--type', type = str, choices = ['partition', 'sd'], default = 'partition', help = "Verify type: The default is Flash partition")
+    verify_parser.add_argument('-p', '--partition', type = str, default = 'user', help = "Flash partition to verify, the default is 'user'")
+    verify_parser.add_argument('-f', '--file', type = Path, default = None, help = "Path to the image file, the project image by default")
+    verify_parser.add_argument('-b', '--baudrate', type = int, default = None, help = "Transfer baud rate, the fastest reliable rate is negotiated by default")
+    verify_parser.add_argument('--timing', action = 'store_true', help = "Print how long each phase of the verification took")
+    verify_parser.add_argument('--no-session', action = 'store_true', help = "Talk to the board directly even if 'mm session' is running")
+    verify_parser.add_argument('--port', type = str, default = None, help = "Serial port of the board, a comma separated list verifies all of them in parallel")
+    verify_parser.add_argument('--serial', type = str, default = None, help = "USB serial number of the board to use, see 'mm boards'")
+    verify_parser.add_argument('--all', action = 'store_true', help = "Verify every attached board in parallel")
+    verify_parser.add_argument('-v', '--verbose', action = 'store_true', help = "Increase the verbosity of the output")
+    verify_parser.set_defaults(func = verify_img)
+
     sync_parser = subparsers.add_parser('copy', help = 'Copy the resources to the Flash or SD card filesystem')
     sync_parser.add_argument('-m', '--mode', type = str, choices = ['sync', 'merge'], default = 'merge', help = "Copy the resources to the destination, the default mode is merge")
     sync_parser.add_argument('-s', '--source', type = Path, default = 'Resources', help = "Source path: The default path is 'Resources' within the project")
     sync_parser.add_argument('-d', '--destination', type = Path, default = '/SD:', help = "Destination path: The default path is '/SD:'")
+    sync_parser.add_argument('-w', '--window', type = int, choices = range(1, 17), metavar = '[1-16]', default = serial_download.DATA_WINDOW_SIZE, help = "Number of data frames in flight, 1 means stop-and-wait")
+    sync_parser.add_argument('--no-compression', action = 'store_true', help = "Always send raw data frames, even if the serial loader supports compression")
+    sync_parser.add_argument('--full', action = 'store_true', help = "Copy every file again instead of only the ones changed since the last copy")
+    sync_parser.add_argument('--trust-local-manifest', action = 'store_true', help = "Skip unchanged files by the local record of the last copy even if the board has no USB serial number, only safe with a single board and SD card on the port")
+    sync_parser.add_argument('--no-batch', action = 'store_true', help = "Copy the files one by one, even if the serial loader can unpack batches of small files")
+    sync_parser.add_argument('--keep-loader', action = 'store_true', help = "Leave the serial loader running instead of rebooting, so the next download/copy can reuse it")
+    sync_parser.add_argument('-b', '--baudrate', type = int, default = None, help = "Transfer baud rate, the fastest reliable rate is negotiated by default")
+    sync_parser.add_argument('--timing', action = 'store_true', help = "Print how long each phase of the download took")
+    sync_parser.add_argument('--metrics-json', type = Path, default = None, help = "Write phase durations, bytes, frame round-trip times, link errors and the baud rate to a JSON file")
+    sync_parser.add_argument('--metrics-prom', type = Path, default = None, help = "Write the same metrics to a Prometheus textfile collector file")
+    sync_parser.add_argument('--capture', type = Path, default = None, help = "Record every frame on the wire to a capture file")
+    sync_parser.add_argument('--capture-payloads', action = 'store_true', help = "Include data frame payloads in the capture")
+    sync_parser.add_argument('--no-session', action = 'store_true', help = "Talk to the board directly even if 'mm session' is running")
+    sync_parser.add_argument('--port', type = str, default = None, help = "Serial port of the board, e.g. the pty of 'mm emulate', a comma separated list flashes all of them in parallel")
+    sync_parser.add_argument('--serial', type = str, default = None, help = "USB serial number of the board to use, see 'mm boards'")
+    sync_parser.add_argument('--all', action = 'store_true', help = "Flash every attached board in parallel")
     sync_parser.add_argument('-v', '--verbose', action = 'store_true', help = "Increase the verbosity of the output")
     sync_parser.set_defaults(func = copy_resources)
 
+    session_parser = subparsers.add_parser('session', help = 'Keep the serial port and the serial loader open for the following download/copy commands')
+    session_parser.add_argument('action', type = str, nargs = '?', choices = ['start', 'stop', 'status'], default = 'start', help = "The default action is start, the session runs until it is stopped")
+    session_parser.add_argument('--port', type = str, default = None, help = "Serial port of the board")
+    session_parser.add_argument('--serial', type = str, default = None, help = "USB serial number of the board to use, see 'mm boards'")
+    session_parser.add_argument('--reboot', action = 'store_true', help = "Reboot the board after every command so the new firmware runs, the next command then restarts the loader")
+    session_parser.add_argument('--detach', action = 'store_true', help = "Run the session in the background")
+    session_parser.add_argument('-v', '--verbose', action = 'store_true', help = "Increase the verbosity of the output")
+    session_parser.set_defaults(func = session.session)
+
+    boards_parser = subparsers.add_parser('boards', help = 'List the attached boards and their USB serial numbers')
+    boards_parser.add_argument('-v', '--verbose', action = 'store_true', help = "Increase the verbosity of the output")
+    boards_parser.set_defaults(func = list_boards)
+
+    emulate_parser = subparsers.add_parser('emulate', help = 'Emulate a SwiftIOMicro in download mode on a pseudo-terminal')
+    emulate_parser.add_argument('--latency', type = float, default = 0.0, help = "Device processing time per frame in seconds")
+    emulate_parser.add_argument('--throughput', type = int, default = 0, help = "Link throughput cap in bytes/s, 0 means unlimited")
+    emulate_parser.add_argument('--baud-limit', action = 'store_true', help = "Limit the link throughput to the current baud rate")
+    emulate_parser.add_argument('--rx-frames', type = int, default = 2, help = "Number of frames the device can buffer")
+    emulate_parser.add_argument('--overrun', action = 'store_true', help = "Drop frames that do not fit in the device buffer")
+    emulate_parser.add_argument('--fault-rate', type = float, default = 0.0, help = "Probability of a fault on each data frame response")
+    emulate_parser.add_argument('--faults', type = str, default = None, help = "Comma separated fault kinds: " + ', '.join(emulator.FAULT_KINDS))
+    emulate_parser.add_argument('--max-baudrate', type = int, default = 0, help = "Garble every response above this baud rate, 0 means no limit")
+    emulate_parser.add_argument('--max-payload', type = int, default = 0, help = "Largest frame payload the emulated serial loader accepts, 0 means 65536")
+    emulate_parser.add_argument('--no-delta', action = 'store_true', help = "Emulate a serial loader without delta update support")
+    emulate_parser.add_argument('--no-verify', action = 'store_true', help = "Emulate a serial loader that can only read files back, not hash them")
+    emulate_parser.add_argument('--no-batch', action = 'store_true', help = "Emulate a serial loader that cannot unpack batched copies")
+    emulate_parser.add_argument('--no-resume', action = 'store_true', help = "Emulate a serial loader without resumable transfers")
+    emulate_parser.add_argument('--no-compression', action = 'store_true', help = "Emulate a serial loader without compressed data frames")
+    emulate_parser.add_argument('--stock', action = 'store_true', help = "Emulate a stock serial loader that reports neither features nor tags")
+    emulate_parser.add_argument('--seed', type = int, default = None, help = "Random seed for fault injection")
+    emulate_parser.add_argument('-v', '--verbose', action = 'store_true', help = "Increase the verbosity of the output")
+    emulate_parser.set_defaults(func = emulator.run)
+
+    replay_parser = subparsers.add_parser('replay', help = 'Replay the device side of a capture on a pseudo-terminal')
+    replay_parser.add_argument('file', type = Path, help = "Path to the capture file")
+    replay_parser.add_argument('--speed', type = float, default = 1.0, help = "Replay speed factor")
+    replay_parser.add_argument('--summary', action = 'store_true', help = "Print a timing summary of the capture instead of replaying it")
+    replay_parser.add_argument('-v', '--verbose', action = 'store_true', help = "Increase the verbosity of the output")
+    replay_parser.set_defaults(func = capture.replay)
+
+    bench_parser = subparsers.add_parser('bench-link', help = 'Benchmark the download link of a board or of the emulator')
+    bench_parser.add_argument('--port', type = str, default = None, help = "Serial port of the board")
+    bench_parser.add_argument('--emulate', action = 'store_true', help = "Benchmark an in-process emulated device")
+    bench_parser.add_argument('--baudrates', type = str, default = '3000000', help = "Comma separated baud rates to sweep")
+    bench_parser.add_argument('--payloads', type = str, default = '4096,16384,65536', help = "Comma separated frame payload sizes to sweep")
+    bench_parser.add_argument('--families', type = str, default = bench.BENCH_DEFAULT_FAMILIES, help = "Comma separated tag families: " + ', '.join(bench.BENCH_FAMILIES) + ". Note 'partition' overwrites the user partition")
+    bench_parser.add_argument('--size', type = int, default = 1024 * 1024, help = "Bytes transferred per measurement")
+    bench_parser.add_argument('--data', type = Path, default = None, help = "Transfer this file instead of --size random bytes, e.g. a real image to measure compression")
+    bench_parser.add_argument('--no-compression', action = 'store_true', help = "Always send raw data frames")
+    bench_parser.add_argument('--repeat', type = int, default = 1, help = "Number of rounds for each baud rate")
+    bench_parser.add_argument('-w', '--window', type = int, choices = range(1, 17), metavar = '[1-16]', default = serial_download.DATA_WINDOW_SIZE, help = "Number of data frames in flight, 1 means stop-and-wait")
+    bench_parser.add_argument('--latency', type = float, default = 0.0, help = "Emulated device processing time per frame in seconds")
+    bench_parser.add_argument('--throughput', type = int, default = 0, help = "Emulated link throughput cap in bytes/s")
+    bench_parser.add_argument('--baud-limit', action = 'store_true', help = "Limit the emulated link throughput to the baud rate")
+    bench_parser.add_argument('-o', '--output', type = str, default = 'bench-link.json', help = "Path of the JSON report")
+    bench_parser.add_argument('-v', '--verbose', action = 'store_true', help = "Increase the verbosity of the output")
+    bench_parser.set_defaults(func = bench.bench_link)
+
     clean_parser = subparsers.add_parser('clean', help = 'Clean project')
     clean_parser.add_argument('--deep', action = 'store_true', help = "Clean all compilation outputs")
     clean_parser.add_argument('-v', '--verbose', action = 'store_true', help = "Increase the verbosity of the output")
@@ -507,7 +739,32 @@ def main():
     util.set_sdk_path(swift_path, sdk_path)
 
     PROJECT_PATH = Path('.').resolve()
-    args.func(args)
+    SERIAL_NAME = vars(args).get('port')
+    SERIAL_ALL = vars(args).get('all', False)
+    serial_download.SERIAL_NUMBER = vars(args).get('serial')
+
+    if vars(args).get('capture') is not None:
+        # The frames of several boards would be interleaved in one file
+        if SERIAL_ALL or (SERIAL_NAME is not None and ',' in SERIAL_NAME):
+            log.die('--capture records a single board, it cannot be combined with --all or a list of ports')
+        serial_download.CAPTURE = capture.Capture(args.capture, payloads=args.capture_payloads)
+    metrics.METRICS_JSON = vars(args).get('metrics_json')
+    metrics.METRICS_PROM = vars(args).get('metrics_prom')
+
+    exit_code = 1
+    try:
+        args.func(args)
+        exit_code = 0
+    except SystemExit as e:
+        exit_code = 0 if e.code is None else e.code if isinstance(e.code, int) else 1
+        raise
+    finally:
+        # A command that died never reached finish_serial_loader()
+        serial_download.record_metrics()
+        metrics.write(exit_code)
+        if serial_download.CAPTURE is not None:
+            serial_download.CAPTURE.close()
+            log.inf('Capture written to ' + str(args.capture))
 
 if __name__ == "__main__":
     multiprocessing.freeze_support()
@@ -1,8 +1,8 @@
-import platform
+import platform, hashlib
 import toml, json
 from zlib import crc32
 from pathlib import Path
-import util, log, version
+import util, log, version, image
 
 SUPPORTED_ARCHS = [
     'thumbv7em-unknown-none-eabi',
@@ -716,23 +716,35 @@ def clean(p_path):
     for file in files:
         file.unlink()
 
+    files = sorted((p_path / '.build' / 'release').glob('*' + IMAGE_STAMP_SUFFIX))
+    for file in files:
+        file.unlink()
+
+
+OBJCOPY_FLAGS = [
+    '-S',
+    '-Obinary',
+    '--gap-fill',
+    '0xFF',
+    '-R',
+    '.comment',
+    '-R',
+    'COMMON',
+    '-R',
+    '.eh_frame'
+]
+
+# Written next to the ELF with the key of the .bin and image made from it,
+# see get_image_key()
+IMAGE_STAMP_SUFFIX = '.image.json'
+IMAGE_HASH_CHUNK_LENGTH = 1024 * 1024
+
 
 def create_binary(build_path, name):
     elf_path = build_path / name
     bin_path = build_path / (name + '.bin')
 
-    flags = [
-        util.get_tool('objcopy'),
-        '-S',
-        '-Obinary',
-        '--gap-fill',
-        '0xFF',
-        '-R',
-        '.comment',
-        '-R',
-        'COMMON',
-        '-R',
-        '.eh_frame',
+    flags = [util.get_tool('objcopy')] + OBJCOPY_FLAGS + [
         util.quote_string(elf_path),
         util.quote_string(bin_path)
     ]
@@ -740,4 +752,56 @@ def create_binary(build_path, name):
     if util.command(flags):
         log.die('creating binary failed!')
     else:
-        return bin_path
\ No newline at end of file
+        return bin_path
+
+
+def get_image_key(elf_path, board_name, image_name):
+    # Everything the .bin and image depend on: the ELF, objcopy and its flags
+    # and the image header parameters
+    key = hashlib.sha256()
+    with elf_path.open('rb') as file:
+        for chunk in iter(lambda: file.read(IMAGE_HASH_CHUNK_LENGTH), b''):
+            key.update(chunk)
+
+    parameters = {
+        'objcopy': [str(util.get_tool_path('objcopy'))] + OBJCOPY_FLAGS,
+        'board': board_name,
+        'image': image_name,
+        'header': [image.IMAGE_HEADER_CAPACITY, image.IMAGE_START_OFFSET, image.IMAGE_LOAD_ADDRESS, image.IMAGE_TYPE, image.IMAGE_VERIFY_TYPE],
+        'version': version.__VERSION__
+    }
+    key.update(json.dumps(parameters, sort_keys=True).encode('utf-8'))
+
+    return key.hexdigest()
+
+
+def get_output_state(path):
+    stat = path.stat()
+
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_image_current(build_path, name, key, outputs):
+    # The outputs are reused if they were made for the same key and nobody
+    # touched them since
+    try:
+        stamp = json.loads((build_path / (name + IMAGE_STAMP_SUFFIX)).read_text(encoding='UTF-8'))
+    except (OSError, ValueError):
+        return False
+
+    if stamp.get('key') != key:
+        return False
+
+    for output in outputs:
+        if not output.is_file() or stamp.get('outputs', {}).get(output.name) != get_output_state(output):
+            return False
+
+    return True
+
+
+def save_image_stamp(build_path, name, key, outputs):
+    stamp = {
+        'key': key,
+        'outputs': {output.name: get_output_state(output) for output in outputs}
+    }
+    (build_path / (name + IMAGE_STAMP_SUFFIX)).write_text(json.dumps(stamp, indent=2), encoding='UTF-8')
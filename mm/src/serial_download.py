@@ -1,22 +1,146 @@
 from pickletools import read_stringnl_noescape
 import serial, serial.tools.list_ports
-from time import sleep
+from collections import deque
+from contextlib import contextmanager
+from time import sleep, monotonic, time
 from pathlib import Path
 from tqdm import tqdm
 from zlib import crc32
-import log, util
+from concurrent.futures import ThreadPoolExecutor
+import os, io, re, json, struct, zlib, hashlib, threading
+import log, util, metrics
 
 
-SERIAL_PORT = None
 SERIAL_INIT_BAUDRATE = 115200
 SERIAL_PORT_READ_TIMEOUT = 5
 SERIAL_PORT_FS_TIMEOUT = 30
 
+# Response timeout of each SYNC attempt. A device that is not ready yet costs
+# one short attempt instead of a fixed delay before every sync
+SYNC_TIMEOUTS = [0.02, 0.05, 0.1, 0.25]
+
+# A sync keeps trying for at least this long per attempt asked for, a slow
+# device gets as much time as the fixed 0.25 s + 0.1 s attempts used to give
+SYNC_ATTEMPT_TIME = 0.4
+
+# Time the serial loader takes to start after EXECUTE
+LOADER_START_TIME = 0.05
+
+# After a reset the ROM prints its info, the line is ready once it is quiet
+RESET_BOOT_TIMEOUT = 0.06
+RESET_QUIET_TIME = 0.005
+
 MAX_PAYLOAD_LENGTH = 65536
 
+# A response header announcing more than this is garbage that happened to
+# contain the preamble
+MAX_RESPONSE_PAYLOAD = 1024 * 1024
+# Device output that is not part of a frame is logged a line at a time
+MAX_OUTPUT_LINE = 256
+
+# Without pipelined frames every frame waits one round trip for its response.
+# Frames are made long enough for that wait to stay under 1/FRAME_RTT_RATIO of
+# the time on the wire, and no longer, so that a failed frame is cheap to resend
+FRAME_RTT_RATIO = 10
+MIN_PAYLOAD_LENGTH = 4096
+
+# Number of data frames kept in flight before waiting for the oldest response.
+# A data tag that fails with more than one frame in flight falls back to
+# stop-and-wait (window of 1) for the rest of the process.
+DATA_WINDOW_SIZE = 4
+
+# A data frame whose response is lost, corrupted or negative is sent again up
+# to this many times before the whole transfer is restarted
+FRAME_RETRIES = 3
+
+# Set to a capture.Capture to record every frame on the wire
+CAPTURE = None
+
+# Baud rates tried from the fastest down, the first one that passes a SYNC and
+# RAM round-trip is used and remembered per board, see get_board_key().
+# Without a remembered rate the probing starts at BAUDRATE_START and only
+# goes up from there if that one works
+BAUDRATE_LADDER = [6000000, 4000000, 3000000, 2000000, 1000000, 460800]
+BAUDRATE_START = 3000000
+BAUDRATE_PROBE_ADDRESS = 0x80000000
+BAUDRATE_PROBE_LENGTH = 16384
+# A rate is probed this many times before the next lower one is tried, a
+# single corrupted frame must not cost the cached rate
+BAUDRATE_PROBE_ATTEMPTS = 2
+BAUDRATE_CACHE = Path.home() / '.madmachine' / 'baudrate.json'
+BAUDRATE_CACHE_EXPIRE = 7 * 24 * 3600
+
+# Only send the partition blocks whose CRC differs from the flash content,
+# when the serial loader supports it
+DELTA_UPDATE = False
+DELTA_BLOCK_SIZE = 4096
+DELTA_WRITE_HEADER = 64 + 4
+
+# Data frames of these tags are sent as raw deflate streams, flagged in the
+# tag, when the serial loader advertises the 'deflate' feature
+COMPRESSION = True
+COMPRESSION_LEVEL = 6
+
+# Skip the transfer when the device already holds the image, see get_first_difference()
+SKIP_IDENTICAL = False
+VERIFY_BLOCK_SIZE = 4096
+VERIFY_CHUNK_LENGTH = 1024 * 1024
+
+# Small files of a copy are packed into one stream per batch, see copy_batch()
+BATCH_COPY = True
+BATCH_LENGTH = 1024 * 1024
+BATCH_FILE_LENGTH = 256 * 1024
+
+# Only send the files of a copy that changed since the last one, see copy_changed_files()
+INCREMENTAL_COPY = True
+# Use the local manifest of a board without a USB serial number, set by
+# --trust-local-manifest
+TRUST_LOCAL_MANIFEST = False
+# The manifests of all copies to a volume live in this directory of it,
+# outside the copied trees
+MANIFEST_DIR = '.mm'
+HASH_CHUNK_LENGTH = 1024 * 1024
+COPY_PREPARE_AHEAD = 8
+COPY_PREPARE_WORKERS = 4
+
+# Leave the serial loader running after a command, the next command on the
+# same port reuses it instead of resetting the board
+KEEP_LOADER = False
+LOADER_STATE = Path.home() / '.madmachine' / 'loader.json'
+
+# Set by 'mm session', the port stays open between commands
+HOLD_PORT = False
+
+# None means negotiate the baud rate
+TARGET_BAUDRATE = None
+
+# USB serial bridges of the supported boards, a PID of None matches every
+# product of the vendor
+USB_SERIAL_BRIDGES = [(0x1A86, None)]
+
+# Board chosen by its USB serial number, and the port each board was last seen on
+SERIAL_NUMBER = None
+DEVICE_CACHE = Path.home() / '.madmachine' / 'devices.json'
+
+# Print how long each phase of a download took
+TIMING = False
+
+# Number of boards flashed at the same time by load_to_devices()
+PARALLEL_DEVICES = 16
+
+# The baud rate cache and the loader state are shared by all boards
+CACHE_LOCK = threading.Lock()
+
 
 FRAME_PREAMBLE = bytes([0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0x5D])
 
+# Preamble, tag and payload length, followed by the payload and a CRC32 of
+# everything after the preamble
+FRAME_HEADER = struct.Struct('>8sII')
+FRAME_CRC = struct.Struct('>I')
+FRAME_OVERHEAD = FRAME_HEADER.size + FRAME_CRC.size
+
+
 SYNC_TAG            = 0x02
 INFO_TAG            = 0x03
 VERSION_TAG         = 0x04
@@ -29,6 +153,7 @@ RAM_BEGIN_TAG       = 0x0A
 RAM_DATA_TAG        = 0x0B
 RAM_END_TAG         = 0x0C
 VERIFY_TAG          = 0x0D
+POSITION_TAG        = 0x0E
 
 FLASH_BEGIN_TAG     = 0x30
 FLASH_DATA_TAG      = 0x31
@@ -48,6 +173,158 @@ FS_RM_TAG           = 0x51
 FS_FILE_BEGIN_TAG   = 0x52
 FS_FILE_DATA_TAG    = 0x53
 FS_FILE_END_TAG     = 0x54
+FS_VERIFY_TAG       = 0x55
+FS_READ_TAG         = 0x56
+FS_BATCH_BEGIN_TAG  = 0x57
+FS_BATCH_DATA_TAG   = 0x58
+FS_BATCH_END_TAG    = 0x59
+
+DATA_DEFLATE_FLAG   = 0x00000100
+
+# Status byte of a response to a frame that failed its CRC check, the device
+# dropped the frame
+STATUS_CRC_ERROR    = 0x01
+
+DATA_TAGS = [RAM_DATA_TAG, FLASH_DATA_TAG, PARTION_DATA_TAG, FS_DATA_TAG, FS_FILE_DATA_TAG, FS_BATCH_DATA_TAG]
+COMPRESSION_TAGS = [PARTION_DATA_TAG, FS_DATA_TAG, FS_FILE_DATA_TAG, FS_BATCH_DATA_TAG]
+
+# Tags of the stock ROM and serial loader. A loader that does not publish a
+# tags= list supports only these, every other tag is an extension
+BASE_TAGS = [
+    SYNC_TAG, INFO_TAG, VERSION_TAG, REBOOT_TAG, EXECUTE_TAG, CHANGE_BAUDRATE_TAG,
+    RAM_BEGIN_TAG, RAM_DATA_TAG, RAM_END_TAG,
+    FLASH_BEGIN_TAG, FLASH_DATA_TAG, FLASH_END_TAG,
+    PARTION_BEGIN_TAG, PARTION_DATA_TAG, PARTION_END_TAG, PARTION_SETBOOT_TAG,
+    FS_BEGIN_TAG, FS_DATA_TAG, FS_END_TAG,
+    FS_MKDIR_TAG, FS_RM_TAG, FS_FILE_BEGIN_TAG, FS_FILE_DATA_TAG, FS_FILE_END_TAG
+]
+
+
+def parse_info(info):
+    # INFO strings start with a name, optionally followed by key=value pairs,
+    # e.g. 'SerialLoader 1.1; features=deflate,delta; max_payload=65536; rx_frames=4'
+    name = ''
+    properties = {}
+    for item in info.split(';'):
+        key, separator, value = item.partition('=')
+        if separator != '':
+            properties[key.strip()] = value.strip()
+        elif name == '':
+            name = item.strip()
+
+    return name, properties
+
+
+def get_int_property(properties, key):
+    try:
+        return int(properties[key])
+    except (KeyError, ValueError):
+        return None
+
+
+def get_tag_set(text):
+    tags = set()
+    for tag in text.split(','):
+        try:
+            tags.add(int(tag, 16))
+        except ValueError:
+            pass
+
+    return tags
+
+
+def get_capabilities(info = '', version = None):
+    # Anything the device does not report is left as None, meaning unknown
+    name, properties = parse_info(info)
+    features = properties.get('features', '')
+    tags = properties.get('tags')
+
+    return {
+        'info': info,
+        'name': name,
+        'version': version,
+        'max_payload': get_int_property(properties, 'max_payload'),
+        'max_baudrate': get_int_property(properties, 'max_baudrate'),
+        'rx_frames': get_int_property(properties, 'rx_frames'),
+        'tags': None if tags is None else get_tag_set(tags),
+        'features': set(feature.strip() for feature in features.split(',') if feature.strip() != ''),
+        'properties': properties
+    }
+
+
+class Device:
+    '''Port, link settings and serial loader state of one board.
+
+    Every function of this module works on the device of the calling thread,
+    see use_device(). ``label`` and ``position`` name the board and place its
+    progress bar when several boards are flashed at once.
+    '''
+
+    def __init__(self, label=None, position=None):
+        self.label = label
+        self.position = position
+        self.port = None
+        self.serial_number = None
+        self.baudrate = SERIAL_INIT_BAUDRATE
+        self.read_timeout = SERIAL_PORT_READ_TIMEOUT
+        self.fs_timeout = SERIAL_PORT_FS_TIMEOUT
+
+        # Data tags that failed with pipelined frames use a window of 1
+        self.data_window = {}
+        self.delta_supported = None
+        self.loader_features = set()
+        self.loader_properties = {}
+        # CRC32 of the serial loader this host uploaded to the board
+        self.loader_crc = None
+
+        # What the ROM or serial loader reported about itself, see
+        # get_capabilities(), and the frame size and window chosen from it
+        self.capabilities = get_capabilities()
+        self.unsupported_tags = set()
+        self.payload_length = MAX_PAYLOAD_LENGTH
+        self.window_size = None
+        self.sync_rtt = None
+
+        # Reused for every frame so that data frames are never rebuilt by
+        # concatenation
+        self.tx_frame = bytearray(FRAME_OVERHEAD + MAX_PAYLOAD_LENGTH)
+        self.rx_frame = bytearray(FRAME_OVERHEAD + 256)
+
+        # Bytes read ahead of the next response, see read_response(), and
+        # the last unfinished line of device output
+        self.rx_buffer = bytearray()
+        self.rx_output = bytearray()
+
+        # Set to a list to collect the round-trip time of every data frame
+        self.frame_rtt = None
+
+        # Failed data frames by kind, and how they were recovered
+        self.link_errors = {}
+
+        # (phase, start, end) of the current command when TIMING is set or
+        # metrics are written
+        self.timing = None
+        self.timing_start = None
+        self.first_data_frame = None
+
+        # Command and image the metrics of the current command are recorded
+        # for, see record_metrics()
+        self.command = None
+        self.image = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+
+DEFAULT_DEVICE = Device()
+THREAD_DEVICE = threading.local()
+
+
+def get_device():
+    return getattr(THREAD_DEVICE, 'device', DEFAULT_DEVICE)
+
+
+def use_device(device):
+    THREAD_DEVICE.device = device
 
 
 def get_uint32_big_bytes(number):
@@ -64,143 +341,479 @@ def get_uint64_big_bytes(number):
     return number.to_bytes(8, byteorder='big')
 
 
-def find_serial_device(device_name):
-    port_list = list(serial.tools.list_ports.grep(device_name))
-    port_path_list = list()
-    for port in port_list:
-        port_path_list.append(port.device)
-    
+def get_serial_ports():
+    return serial.tools.list_ports.comports()
+
+
+def match_serial_port(port, device_name):
+    # Same fields as serial.tools.list_ports.grep()
+    return (re.search(device_name, port.device, re.I) is not None or
+            re.search(device_name, port.description, re.I) is not None or
+            re.search(device_name, port.hwid, re.I) is not None)
+
+
+def is_usb_bridge(port):
+    for vid, pid in USB_SERIAL_BRIDGES:
+        if port.vid == vid and (pid is None or port.pid == pid):
+            return True
+
+    return False
+
+
+def find_serial_device(device_name, ports = None, bridges = False):
+    # Only list_ports metadata is used, no port is opened. With bridges set,
+    # every port of a known USB serial bridge matches as well
+    if ports is None:
+        ports = get_serial_ports()
+
+    # A full port path only selects that port, a pattern would also match
+    # e.g. /dev/ttyUSB10 for /dev/ttyUSB1
+    port_path_list = [port.device for port in ports if port.device == device_name]
+    if len(port_path_list) == 0:
+        port_path_list = [port.device for port in ports if match_serial_port(port, device_name) or (bridges and is_usb_bridge(port))]
+
+    # Ports that are not USB devices (e.g. the pty of the device emulator)
+    # are never listed, accept them by path
+    if len(port_path_list) == 0 and Path(device_name).exists():
+        port_path_list.append(device_name)
+
     if len(port_path_list) == 0:
         port_path_list = None
 
     return port_path_list
 
 
-def init_serial_device(device_name):
-    global SERIAL_PORT
+def get_serial_number(port_path, ports):
+    for port in ports:
+        if port.device == port_path:
+            return port.serial_number
 
-    port_path_list = find_serial_device(device_name)
+    return None
 
-    if port_path_list is None:
-        log.die('Please confirm ' + device_name + ' is correctly connected to your computer!')
-    elif len(port_path_list) > 1:
-        log.wrn('Found more than one ' + device_name)
 
-    for port_path in port_path_list:
+def load_device_cache():
+    try:
+        return json.loads(DEVICE_CACHE.read_text(encoding='UTF-8'))
+    except (OSError, ValueError):
+        return {}
+
+
+def save_device_cache(serial_number, port_path):
+    if serial_number is None:
+        return
+
+    with CACHE_LOCK:
+        cache = load_device_cache()
+        cache[serial_number] = {'port': port_path, 'time': time()}
         try:
-            SERIAL_PORT = serial.Serial(port_path, SERIAL_INIT_BAUDRATE, 8, 'N', 1)
-        except IOError:
-            log.wrn('Device or resource busy! Please make sure it is not in use!')
-
-        if SERIAL_PORT is not None and SERIAL_PORT.is_open:
-            SERIAL_PORT.timeout = SERIAL_PORT_READ_TIMEOUT
-            SERIAL_PORT.reset_output_buffer()
-            SERIAL_PORT.reset_input_buffer()
-            if len(port_path_list) > 1:
-                reset_to_download()
-                ret = sync(3)
-                if ret:
-                    SERIAL_PORT.reset_output_buffer()
-                    SERIAL_PORT.reset_input_buffer()
-                    log.inf('Open ' + port_path + ' success')
-                    break
-                else:
-                    deinit_serial_device()
-            else:
-                log.inf('Open ' + port_path + ' success')
-        else:
-            log.wrn('Open ' + port_path + ' failed!')
-    
-    if SERIAL_PORT is None or not SERIAL_PORT.is_open:
-        log.die('Open ' + device_name + ' failed!')
-    
+            DEVICE_CACHE.parent.mkdir(parents=True, exist_ok=True)
+            DEVICE_CACHE.write_text(json.dumps(cache, indent=2), encoding='UTF-8')
+        except OSError:
+            log.dbg('cannot write ' + str(DEVICE_CACHE))
+
+
+def find_serial_number(serial_number, ports):
+    for port in ports:
+        if port.serial_number == serial_number:
+            return port.device
+
+    # Some bridges do not report their serial number on every system, the
+    # last known port of the board is tried then
+    port_path = load_device_cache().get(serial_number, {}).get('port')
+    if port_path is not None and Path(port_path).exists():
+        log.wrn('Board ' + serial_number + ' not listed, using its last port ' + port_path)
+        return port_path
+
+    return None
+
+
+def get_last_used(port_path_list, ports):
+    # The most recently used board among the candidates, if any is known
+    cache = load_device_cache()
+    last_used = None
+    last_time = 0
+    for port_path in port_path_list:
+        entry = cache.get(get_serial_number(port_path, ports))
+        if entry is not None and entry.get('port') == port_path and entry.get('time', 0) > last_time:
+            last_used = port_path
+            last_time = entry['time']
+
+    return last_used
+
+
+def probe_serial_device(port_path):
+    # Runs in a thread of its own, so the probe gets its own Device
+    device = Device(label=port_path)
+    use_device(device)
+    try:
+        device.port = serial.Serial(port_path, SERIAL_INIT_BAUDRATE, 8, 'N', 1, timeout=device.read_timeout)
+        reset_to_download()
+        return sync(3)
+    except (IOError, SystemExit):
+        return False
+    finally:
+        if device.port is not None and device.port.is_open:
+            device.port.close()
+
+
+def select_serial_device(device_name, port_path_list, ports):
+    last_used = get_last_used(port_path_list, ports)
+    if last_used is not None:
+        log.inf('Found ' + str(len(port_path_list)) + ' ' + device_name + ' ports, using the last used board on ' + last_used + ', choose another one with --serial')
+        return last_used
+
+    # Nothing tells the boards apart, probe all of them at once
+    log.wrn('Found more than one ' + device_name + ', probing ' + ', '.join(port_path_list))
+    with ThreadPoolExecutor(max_workers=min(len(port_path_list), PARALLEL_DEVICES)) as pool:
+        results = list(pool.map(probe_serial_device, port_path_list))
+
+    for port_path, result in zip(port_path_list, results):
+        if result:
+            return port_path
+
+    return None
+
+
+def init_serial_device(device_name):
+    device = get_device()
+
+    if HOLD_PORT and device.port is not None and device.port.is_open:
+        return
+
+    ports = get_serial_ports()
+    if SERIAL_NUMBER is not None:
+        port_path = find_serial_number(SERIAL_NUMBER, ports)
+        if port_path is None:
+            log.die('Board ' + SERIAL_NUMBER + ' is not connected!')
+    else:
+        port_path_list = find_serial_device(device_name, ports)
+        if port_path_list is None:
+            log.die('Please confirm ' + device_name + ' is correctly connected to your computer!')
+
+        port_path = port_path_list[0]
+        if len(port_path_list) > 1:
+            port_path = select_serial_device(device_name, port_path_list, ports)
+            if port_path is None:
+                log.die('None of the ' + device_name + ' ports answered')
+
+    try:
+        device.port = serial.Serial(port_path, SERIAL_INIT_BAUDRATE, 8, 'N', 1)
+        device.baudrate = SERIAL_INIT_BAUDRATE
+    except IOError:
+        log.wrn('Device or resource busy! Please make sure it is not in use!')
+
+    if device.port is None or not device.port.is_open:
+        log.die('Open ' + port_path + ' failed!')
+
+    device.port.timeout = device.read_timeout
+    device.port.reset_output_buffer()
+    reset_input(device)
+    device.serial_number = get_serial_number(port_path, ports)
+    save_device_cache(device.serial_number, port_path)
+    log.inf(get_label() + 'Open ' + port_path + ' success')
 
 
 def deinit_serial_device():
-    if SERIAL_PORT is not None and SERIAL_PORT.is_open:
-        SERIAL_PORT.close()
+    if HOLD_PORT:
+        return
+
+    port = get_device().port
+    if port is not None and port.is_open:
+        port.close()
 
 
 def reset_to_download():
-    SERIAL_PORT.dtr = False    #DTR = 1, RTS = 1 | BOOT = Pullup,   RESET = Pullup,
-    SERIAL_PORT.rts = True     #DTR = 1, RTS = 0 | BOOT = Pullup,   RESET = 0,
+    if CAPTURE is not None:
+        CAPTURE.record_reset()
+
+    try:
+        reset_by_modem_lines()
+    except OSError:
+        log.dbg(get_device().port.port + ' has no modem control lines, reset skipped')
+
+
+def reset_by_modem_lines():
+    port = get_device().port
+
+    port.dtr = False    #DTR = 1, RTS = 1 | BOOT = Pullup,   RESET = Pullup,
+    port.rts = True     #DTR = 1, RTS = 0 | BOOT = Pullup,   RESET = 0,
     sleep(0.04)
 
-    SERIAL_PORT.dtr = True     #DTR = 0, RTS = 0 | BOOT = Pullup, RESET = Charging,
+    port.dtr = True     #DTR = 0, RTS = 0 | BOOT = Pullup, RESET = Charging,
     # Large capacitor at RESET pin
-    SERIAL_PORT.rts = False    #DTR = 0, RTS = 1 | BOOT = 0,      RESET = From 0 to Pullup,
-    sleep(0.06)                # ~0.01: EN pull up done; ~0.02: ROM init done; ~0.04: info output done
+    port.rts = False    #DTR = 0, RTS = 1 | BOOT = 0,      RESET = From 0 to Pullup,
+    wait_boot_output(port, RESET_BOOT_TIMEOUT)    # ~0.01: EN pull up done; ~0.02: ROM init done; ~0.04: info output done
+
+    port.dtr = False    #DTR = 1, RTS = 1 | BOOT = Pullup, RESET = Pullup,
+
+
+
+
+
+def wait_boot_output(port, timeout):
+    # Return as soon as the boot output of the ROM is over, a device that
+    # prints nothing gets the whole timeout
+    deadline = monotonic() + timeout
+    received = 0
+    quiet_since = monotonic()
+    while monotonic() < deadline:
+        waiting = port.in_waiting
+        if waiting != received:
+            received = waiting
+            quiet_since = monotonic()
+        elif received > 0 and monotonic() - quiet_since >= RESET_QUIET_TIME:
+            return
+        sleep(0.002)
+
+
+def reset_input(device):
+    device.port.reset_input_buffer()
+    device.rx_buffer.clear()
+
+
+def drain_input(port):
+    # Discard whatever the USB-serial chip has buffered, without waiting for
+    # a read timeout
+    get_device().rx_buffer.clear()
+    port.reset_input_buffer()
+    while port.in_waiting > 0:
+        port.read(port.in_waiting)
+
+
+def start_timing(command = None, image = None):
+    device = get_device()
+
+    device.timing = [] if TIMING or metrics.is_enabled() else None
+    device.timing_start = monotonic()
+    device.first_data_frame = None
+    device.link_errors = {}
+    device.command = command
+    device.image = image
+    device.bytes_sent = 0
+    device.bytes_received = 0
+    if metrics.is_enabled():
+        device.frame_rtt = []
+
+
+@contextmanager
+def timing_phase(name):
+    device = get_device()
+    start = monotonic()
+    try:
+        yield
+    finally:
+        if device.timing is not None:
+            device.timing.append((name, start, monotonic()))
+
+
+def print_timing():
+    device = get_device()
+    if device.timing is None or not TIMING:
+        device.timing = None
+        return
+
+    log.inf(get_label() + 'Timing:')
+    for name, start, end in device.timing:
+        log.inf('  {:<18} {:8.3f}s'.format(name, end - start))
+    if device.first_data_frame is not None:
+        log.inf('  {:<18} {:8.3f}s after start'.format('first data frame', device.first_data_frame - device.timing_start))
+    log.inf('  {:<18} {:8.3f}s'.format('total', monotonic() - device.timing_start))
+    device.timing = None
+
+
+def count_link_error(name, device = None):
+    if device is None:
+        device = get_device()
+
+    device.link_errors[name] = device.link_errors.get(name, 0) + 1
 
-    SERIAL_PORT.dtr = False    #DTR = 1, RTS = 1 | BOOT = Pullup, RESET = Pullup,
 
+def record_metrics():
+    device = get_device()
+    if not metrics.is_enabled() or device.command is None:
+        return
 
+    labels = {'command': device.command, 'port': device.port.port if device.port is not None else ''}
+    for name, start, end in device.timing:
+        metrics.record('phase_seconds', end - start, phase=name, **labels)
+    metrics.record('command_seconds', monotonic() - device.timing_start, **labels)
+    if device.first_data_frame is not None:
+        metrics.record('first_frame_seconds', device.first_data_frame - device.timing_start, **labels)
+    metrics.record('bytes_sent', device.bytes_sent, **labels)
+    metrics.record('bytes_received', device.bytes_received, **labels)
+    metrics.record('frame_rtt_seconds', device.frame_rtt or [], **labels)
+    metrics.record('baudrate', device.baudrate, **labels)
+    for name, count in device.link_errors.items():
+        metrics.record('link_errors', count, kind=name, **labels)
+    if device.image is not None:
+        metrics.record('image_bytes', Path(device.image).stat().st_size, image=Path(device.image).name, **labels)
+
+    device.command = None
+    device.frame_rtt = None
+
+
+def print_link_errors():
+    device = get_device()
+    if len(device.link_errors) == 0:
+        return
+
+    log.inf(get_label() + 'Link errors: ' + ', '.join(name + ' ' + str(count) for name, count in sorted(device.link_errors.items())))
+
+
+def get_tx_frame(payload_length):
+    device = get_device()
+
+    # A larger buffer replaces the old one, views into it may still be alive
+    if len(device.tx_frame) < FRAME_OVERHEAD + payload_length:
+        device.tx_frame = bytearray(FRAME_OVERHEAD + payload_length)
+
+    return memoryview(device.tx_frame)
+
+
+def get_rx_frame(payload_length):
+    device = get_device()
+
+    if len(device.rx_frame) < FRAME_OVERHEAD + payload_length:
+        device.rx_frame = bytearray(FRAME_OVERHEAD + payload_length)
+
+    return memoryview(device.rx_frame)
+
+
+def get_request_payload(payload_length):
+    # Callers may fill the request payload in place, send_request() then
+    # skips copying it into the frame buffer
+    return get_tx_frame(payload_length)[FRAME_HEADER.size : FRAME_HEADER.size + payload_length]
+
+
+def encode_frame(tag, payload = None):
+    payload_length = 0 if payload is None else len(payload)
+    frame = get_tx_frame(payload_length)
+    payload_end = FRAME_HEADER.size + payload_length
+
+    FRAME_HEADER.pack_into(frame, 0, FRAME_PREAMBLE, tag, payload_length)
+    if payload_length > 0:
+        if not isinstance(payload, memoryview) or payload.obj is not frame.obj:
+            frame[FRAME_HEADER.size : payload_end] = payload
+        crc = crc32(frame[FRAME_HEADER.size : payload_end], crc32(frame[8 : FRAME_HEADER.size]))
+    else:
+        crc = crc32(frame[8 : FRAME_HEADER.size])
+    FRAME_CRC.pack_into(frame, payload_end, crc)
 
+    return frame[: payload_end + FRAME_CRC.size]
 
 
 def send_request(tag, payload = None):
     if not isinstance(tag, int):
         log.dbg('tag must be 32bit int')
         exit(1)
-    
-    if payload == None:
-        tag = get_uint32_big_bytes(tag)
-        length = get_uint32_big_bytes(0)
-        crc =  get_uint32_big_bytes(crc32(tag + length))
-        log.dbg('request:')
-        log.dbg('    tag: 0x' + tag.hex())
-        log.dbg('    length: 0x' + length.hex())
-        log.dbg('    payload: None')
-        log.dbg('    crc: 0x' + crc.hex())
-        SERIAL_PORT.write(FRAME_PREAMBLE + tag + length + crc)
-    else:
-        if not isinstance(payload, bytes) and not isinstance(payload, bytearray):
-            log.dbg('payload must be bytes or bytearray')
-            exit(1)
-        tag = get_uint32_big_bytes(tag)
-        length = get_uint32_big_bytes(len(payload))
-        crc =  get_uint32_big_bytes(crc32(tag + length + payload))
+
+    if payload is not None and not isinstance(payload, (bytes, bytearray, memoryview)):
+        log.dbg('payload must be bytes, bytearray or memoryview')
+        exit(1)
+
+    frame = encode_frame(tag, payload)
+    if log.VERBOSE >= log.VERBOSE_DBG:
         log.dbg('request:')
-        log.dbg('    tag: 0x' + tag.hex())
-        log.dbg('    length: 0x' + length.hex())
-        log.dbg('    payload: ' + str(int.from_bytes(length, 'big', signed='False')) + 'bytes')
-        log.dbg('    crc: 0x' + crc.hex())
-        SERIAL_PORT.write(FRAME_PREAMBLE + tag + length + payload + crc)
+        log.dbg('    tag: 0x' + frame[8:12].hex())
+        log.dbg('    length: 0x' + frame[12:16].hex())
+        log.dbg('    payload: ' + str(len(frame) - FRAME_OVERHEAD) + 'bytes')
+        log.dbg('    crc: 0x' + frame[-4:].hex())
 
-def wait_response():
-    header = SERIAL_PORT.read(16)
+    if CAPTURE is not None:
+        CAPTURE.record_request(frame)
+    device = get_device()
+    device.port.write(frame)
+    device.bytes_sent += len(frame)
 
-    if not header.startswith(FRAME_PREAMBLE) or len(header) != 16:
-        log.dbg('response: ')
-        log.dbg('    Header transfer error!')
-        return None
 
-    payload_length = int.from_bytes(header[12:16], 'big', signed='False')
-    rest = SERIAL_PORT.read(payload_length + 4)
-    if len(rest) != payload_length + 4:
-        log.dbg('response: ')
-        log.dbg('    Need: ' + str(payload_length + 4) + ' Received: ' + str(len(rest)))
-        return None
+def wait_response():
+    response = read_response()
+    if CAPTURE is not None:
+        CAPTURE.record_response(response)
 
-    response = header[8:] + rest
     return response
 
-def response_check_crc(response):   
-    tag = response[0:4]
-    length = response[4:8]
-    payload = response[8:-4]
-    payload_length = int.from_bytes(length, 'big', signed='False')
-    crc = response[-4:]
 
-    log.dbg('response: ')
-    log.dbg('    tag: 0x' + tag.hex())
-    log.dbg('    length: 0x' + length.hex())
-    log.dbg('    payload: ' + payload.hex())
-    log.dbg('    crc: 0x' + crc.hex())
-    log.dbg('')
+def receive(device, length):
+    # Reads at least length bytes into the receive buffer, together with
+    # everything else that already arrived
+    port = device.port
+    data = port.read(max(length, port.in_waiting))
+    device.bytes_received += len(data)
+    device.rx_buffer += data
+
+    return len(data) >= length
+
+
+def skip_output(device, length):
+    # Boot ROM messages and other bytes in front of a frame are not part of
+    # the protocol
+    if length == 0:
+        return
 
-    cal_crc = get_uint32_big_bytes(crc32(tag + length + payload))
+    device.rx_output += device.rx_buffer[:length]
+    del device.rx_buffer[:length]
 
-    return crc == cal_crc
+    lines = device.rx_output.split(b'\n')
+    device.rx_output = lines.pop()
+    if len(device.rx_output) > MAX_OUTPUT_LINE:
+        lines.append(device.rx_output)
+        device.rx_output = bytearray()
+    for line in lines:
+        log.dbg(get_label() + 'device output: ' + line.decode('utf-8', 'replace').rstrip())
+
+
+def read_response():
+    # Scans the receive buffer for the next frame and resynchronizes on its
+    # preamble. The returned memoryview points into the receive frame buffer
+    # of the device and is only valid until the next call
+    device = get_device()
+    buffer = device.rx_buffer
+
+    while True:
+        start = buffer.find(FRAME_PREAMBLE)
+        if start < 0:
+            # Keep what may be the start of a preamble
+            skip_output(device, max(0, len(buffer) - len(FRAME_PREAMBLE) + 1))
+            missing = FRAME_HEADER.size - len(buffer)
+        else:
+            skip_output(device, start)
+            missing = FRAME_HEADER.size - len(buffer)
+            if missing <= 0:
+                payload_length = FRAME_HEADER.unpack_from(buffer)[2]
+                if payload_length > MAX_RESPONSE_PAYLOAD:
+                    skip_output(device, 1)
+                    continue
+                frame_length = FRAME_OVERHEAD + payload_length
+                missing = frame_length - len(buffer)
+                if missing <= 0:
+                    break
+
+        if not receive(device, missing):
+            log.dbg('response: ')
+            log.dbg('    Need: ' + str(missing) + ' more bytes, received: ' + str(len(buffer)))
+            # The rest of the frame is lost, a late one must not be joined to it
+            buffer.clear()
+            return None
+
+    frame = get_rx_frame(payload_length)
+    frame[: frame_length] = buffer[: frame_length]
+    del buffer[: frame_length]
+
+    return frame[8 : frame_length]
+
+def response_check_crc(response):
+    crc = FRAME_CRC.unpack_from(response, len(response) - FRAME_CRC.size)[0]
+
+    if log.VERBOSE >= log.VERBOSE_DBG:
+        log.dbg('response: ')
+        log.dbg('    tag: 0x' + response[0:4].hex())
+        log.dbg('    length: 0x' + response[4:8].hex())
+        log.dbg('    payload: ' + response[8:-4].hex())
+        log.dbg('    crc: 0x' + response[-4:].hex())
+        log.dbg('')
+
+    return crc == crc32(response[:-4])
 
 
 def response_verify(response, req_tag):
@@ -241,37 +854,68 @@ def response_verify(response, req_tag):
     return True
 
 
+def get_response_error(response, req_tag):
+    # None for a good response, otherwise what went wrong with it
+    if response is None:
+        return 'timeout'
+    if not response_check_crc(response):
+        return 'crc'
+    if response[0] != 0x80 or response[3] != req_tag & 0xFF:
+        return 'framing'
+    if response[1] == STATUS_CRC_ERROR:
+        return 'nak'
+    if response[1] != 0x00:
+        return 'status'
+
+    return None
+
+
 def response_get_payload(response):
     return response[8:-4]
 
 
-def sync(try_count = 6):
+def sync(try_count = 6, reset_output = True):
+    device = get_device()
+    port = device.port
     count = 0
     result = False
-    previous_timeout = SERIAL_PORT.timeout
+    previous_timeout = port.timeout
+    deadline = monotonic() + try_count * SYNC_ATTEMPT_TIME
     
-    SERIAL_PORT.timeout = 0.25
-    # Clear the USB-Serial chip buffer by reading
-    SERIAL_PORT.read(MAX_PAYLOAD_LENGTH)
-    print('Serial port synchronizing', end = '', flush = True)
-    while count < try_count:
+    # Progress dots of several boards would interleave
+    dots = device.label is None
+    if dots:
+        print('Serial port synchronizing', end = '', flush = True)
+    while count < try_count or monotonic() < deadline:
+        port.timeout = SYNC_TIMEOUTS[min(count, len(SYNC_TIMEOUTS) - 1)]
         count += 1
-        print('.', end = '', flush = True)
-        SERIAL_PORT.reset_output_buffer()
-        SERIAL_PORT.reset_input_buffer()
+        if dots:
+            print('.', end = '', flush = True)
+        # Not in the middle of a transfer, a frame cut short in the output
+        # buffer would leave the device waiting for the rest of it
+        if reset_output:
+            port.reset_output_buffer()
+        drain_input(port)
+        sent_time = monotonic()
         send_request(SYNC_TAG)
         response = wait_response()
 
         if response_verify(response, SYNC_TAG):
+            device.sync_rtt = monotonic() - sent_time
             result = True
             break
-        else:
-            sleep(0.1)
     
-    print('', flush=True)
-    SERIAL_PORT.timeout = previous_timeout
+    # A late response to an earlier attempt must not be taken for the answer
+    # to the next request
+    if result and count > 1:
+        sleep(SYNC_TIMEOUTS[0])
+        drain_input(port)
+
+    if dots:
+        print('', flush=True)
+    port.timeout = previous_timeout
     if not result:
-        log.wrn('serial port synchronization failed!')
+        log.wrn(get_label() + 'serial port synchronization failed!')
 
     return result
 
@@ -286,14 +930,6 @@ def mem_begin(target_addr, target_length):
         log.die('mem_begin failed')
 
 
-def mem_data(payload):
-    send_request(RAM_DATA_TAG, payload)
-    response = wait_response()
-    if not response_verify(response, RAM_DATA_TAG):
-        log.die('mem_data failed')
-
-
-
 def mem_end(bin_crc):
     payload = get_uint32_big_bytes(bin_crc)
 
@@ -315,13 +951,6 @@ def flash_begin(image_offset, image_length):
         log.die('flash_begin failed!')
 
 
-def flash_data(payload):
-    send_request(FLASH_DATA_TAG, payload)
-    response = wait_response()
-    if not response_verify(response, FLASH_DATA_TAG):
-        log.die('flash_data failed!')
-
-
 def flash_end(bin_crc):
     bin_crc = get_uint32_big_bytes(bin_crc)
     payload = bin_crc
@@ -345,13 +974,6 @@ def partion_begin(name, image_length):
         log.die('partion_begin failed!')
 
 
-def partion_data(payload):
-    send_request(PARTION_DATA_TAG, payload)
-    response = wait_response()
-    if not response_verify(response, PARTION_DATA_TAG):
-        log.die('partion_data failed!')
-
-
 def partion_end(bin_crc):
     bin_crc = get_uint32_big_bytes(bin_crc)
     payload = bin_crc
@@ -373,6 +995,155 @@ def partion_set_boot(name):
         log.die('set boot partion failed!')
 
 
+# Loader extension used by delta updates:
+# VERIFY request: partition name (64) + offset (4) + length (4) + block size (4),
+#                 response payload is the CRC32 of every block of the range
+# WRITE request:  partition name (64) + offset (4) + data, the loader erases
+#                 and programs the range
+
+# Loader extension used by resumable transfers ('resume' feature):
+# POSITION request has no payload, the response payload is the number of data
+# bytes (4) the current transfer accepted. After a data frame it had to reject
+# the loader rejects every following data frame until it is asked for the
+# position, so the host can go back to the first frame that was lost
+
+def get_transfer_position():
+    # The responses still on their way are dropped by sync()
+    if not sync(reset_output = False):
+        return None
+
+    send_request(POSITION_TAG)
+    response = wait_response()
+    if not response_verify(response, POSITION_TAG):
+        return None
+
+    payload = response_get_payload(response)
+    if len(payload) != 4:
+        return None
+
+    return int.from_bytes(payload, 'big')
+
+
+def get_resume_position(error, frame_offset, pending):
+    # Where a transfer continues after a failed frame, None if only a restart
+    # is safe. Without the extension, a frame rejected with a CRC error was
+    # dropped by the device, so with nothing sent behind it the same frame can
+    # be sent again
+    if 'resume' in get_device().loader_features:
+        return get_transfer_position()
+
+    if error == 'nak' and not pending:
+        return frame_offset
+
+    return None
+
+
+def partion_verify(name, offset, length, block_size):
+    payload = bytes(name, 'utf-8').ljust(64, b'\x00')
+    payload += get_uint32_big_bytes(offset) + get_uint32_big_bytes(length) + get_uint32_big_bytes(block_size)
+
+    send_request(VERIFY_TAG, payload)
+    response = wait_response()
+    if not response_verify(response, VERIFY_TAG):
+        return None
+
+    payload = response_get_payload(response)
+    count = (length + block_size - 1) // block_size
+    if len(payload) != count * 4:
+        return None
+
+    return list(struct.unpack('>' + str(count) + 'I', payload))
+
+
+def partion_write(name, offset, file, length):
+    payload = get_request_payload(DELTA_WRITE_HEADER + length)
+    payload[0:64] = bytes(name, 'utf-8').ljust(64, b'\x00')
+    payload[64:68] = get_uint32_big_bytes(offset)
+    file.seek(offset)
+    if read_payload(file, payload[DELTA_WRITE_HEADER:]) != length:
+        log.die('read ' + file.name + ' failed, the file was changed during the transfer')
+
+    return request(WRITE_TAG, payload)
+
+
+def get_file_block_crcs(file, block_size):
+    block_crcs = []
+    file_crc = 0
+    buffer = bytearray(block_size)
+
+    file.seek(0)
+    while True:
+        length = read_payload(file, memoryview(buffer))
+        if length == 0:
+            break
+        block = memoryview(buffer)[:length]
+        block_crcs.append(crc32(block))
+        file_crc = crc32(block, file_crc)
+
+    return block_crcs, file_crc
+
+
+def get_changed_ranges(local_crcs, remote_crcs, file_length):
+    # Adjacent changed blocks are merged into ranges that fit in one frame
+    max_length = max(DELTA_BLOCK_SIZE, (get_payload_length() - DELTA_WRITE_HEADER) // DELTA_BLOCK_SIZE * DELTA_BLOCK_SIZE)
+    ranges = []
+    for index in range(len(local_crcs)):
+        if local_crcs[index] == remote_crcs[index]:
+            continue
+        offset = index * DELTA_BLOCK_SIZE
+        length = min(DELTA_BLOCK_SIZE, file_length - offset)
+        if len(ranges) > 0 and ranges[-1][0] + ranges[-1][1] == offset and ranges[-1][1] + length <= max_length:
+            ranges[-1][1] += length
+        else:
+            ranges.append([offset, length])
+
+    return ranges
+
+
+def send_file2partion_delta(f, partition_name):
+    device = get_device()
+
+    file_length = f.stat().st_size
+    if device.delta_supported == False or file_length == 0:
+        return False
+    if not is_tag_supported(VERIFY_TAG) or not is_tag_supported(WRITE_TAG):
+        device.delta_supported = False
+        return False
+
+    remote_crcs = partion_verify(partition_name, 0, file_length, DELTA_BLOCK_SIZE)
+    if remote_crcs is None:
+        log.wrn('The serial loader does not support delta updates, sending the whole image')
+        device.delta_supported = False
+        sync()
+        return False
+    device.delta_supported = True
+
+    with f.open('rb', buffering=0) as file:
+        local_crcs, file_crc = get_file_block_crcs(file, DELTA_BLOCK_SIZE)
+        ranges = get_changed_ranges(local_crcs, remote_crcs, file_length)
+        changed_length = sum(length for offset, length in ranges)
+        log.inf('Delta update: ' + str(changed_length) + ' of ' + str(file_length) + ' bytes changed')
+
+        process_bar = get_process_bar(changed_length)
+        for offset, length in ranges:
+            if not partion_write(partition_name, offset, file, length):
+                process_bar.close()
+                log.wrn('Delta update failed, sending the whole image')
+                sync()
+                return False
+            process_bar.update(length)
+        process_bar.close()
+
+    # The per-block CRCs only select what to send, the whole partition range
+    # is checked once more before it is trusted
+    if partion_verify(partition_name, 0, file_length, file_length) != [file_crc]:
+        log.wrn('Delta update verification failed, sending the whole image')
+        sync()
+        return False
+
+    return True
+
+
 
 
 def sdcard_begin(image_length, image_path):
@@ -387,14 +1158,6 @@ def sdcard_begin(image_length, image_path):
         log.die('sdcard_begin failed!')
 
 
-def sdcard_data(payload):
-    send_request(FS_DATA_TAG, payload)
-    response = wait_response()
-    if not response_verify(response, FS_DATA_TAG):
-        log.die('sdcard_begin failed!')
-
-
-
 def sdcard_end(bin_crc):
     bin_crc = get_uint32_big_bytes(bin_crc)
 
@@ -420,13 +1183,6 @@ def fs_file_begin(image_length, image_path):
         log.die('fs_file_begin failed!')
 
 
-def fs_file_data(payload):
-    send_request(FS_FILE_DATA_TAG, payload)
-    response = wait_response()
-    if not response_verify(response, FS_FILE_DATA_TAG):
-        log.die('fs_file_data failed!')
-
-
 def fs_file_end(bin_crc):
     bin_crc = get_uint32_big_bytes(bin_crc)
 
@@ -439,6 +1195,107 @@ def fs_file_end(bin_crc):
 
 
 
+# Loader extension used by verification, the response payloads of the file
+# requests start with the size of the file and stop at its end. A missing
+# file reads as an empty one:
+# FS_VERIFY request: offset (4) + length (4) + block size (4) + path, response
+#                    payload is followed by the CRC32 of every block of the range
+# FS_READ request:   offset (4) + length (4) + path, response payload is
+#                    followed by the data of the range
+# READ request:      partition name (64) + offset (4) + length (4), response
+#                    payload is the data of the range
+
+def fs_file_verify(path, offset, length, block_size):
+    payload = get_uint32_big_bytes(offset) + get_uint32_big_bytes(length) + get_uint32_big_bytes(block_size)
+    payload += bytes(path, 'utf-8') + b'\x00'
+
+    send_request(FS_VERIFY_TAG, payload)
+    response = wait_response()
+    if not response_verify(response, FS_VERIFY_TAG):
+        return None
+
+    payload = response_get_payload(response)
+    if len(payload) < 4 or len(payload) % 4 != 0:
+        return None
+
+    values = struct.unpack('>' + str(len(payload) // 4) + 'I', payload)
+
+    return values[0], list(values[1:])
+
+
+def fs_file_read(path, offset, length):
+    payload = get_uint32_big_bytes(offset) + get_uint32_big_bytes(length) + bytes(path, 'utf-8') + b'\x00'
+
+    send_request(FS_READ_TAG, payload)
+    response = wait_response()
+    if not response_verify(response, FS_READ_TAG):
+        return None
+
+    payload = response_get_payload(response)
+    if len(payload) < 4:
+        return None
+
+    return int.from_bytes(payload[0:4], 'big'), bytes(payload[4:])
+
+
+def fs_read_file(path):
+    # Whole file read back a frame at a time, None if the loader cannot
+    read_length = max(1, get_payload_length() - 4)
+    data = bytearray()
+    while True:
+        result = fs_file_read(path, len(data), read_length)
+        if result is None:
+            get_device().unsupported_tags.add(FS_READ_TAG)
+            return None
+        size, chunk = result
+        data += chunk
+        if len(data) >= size or len(chunk) == 0:
+            return bytes(data[:size])
+
+
+def partion_read(name, offset, length):
+    payload = bytes(name, 'utf-8').ljust(64, b'\x00')
+    payload += get_uint32_big_bytes(offset) + get_uint32_big_bytes(length)
+
+    send_request(READ_TAG, payload)
+    response = wait_response()
+    if not response_verify(response, READ_TAG):
+        return None
+
+    payload = response_get_payload(response)
+    if len(payload) != length:
+        return None
+
+    return bytes(payload)
+
+
+# Loader extension for batched copies, the stream sent with FS_BATCH_DATA is a
+# sequence of records: kind (1) + path length (2) + data length (4) + path +
+# data. The loader unpacks it after FS_BATCH_END checked its CRC32
+BATCH_RECORD = struct.Struct('>BHI')
+BATCH_DIR = 0x44
+BATCH_FILE = 0x46
+
+def fs_batch_begin(stream_length):
+    send_request(FS_BATCH_BEGIN_TAG, get_uint32_big_bytes(stream_length))
+    response = wait_response()
+    if not response_verify(response, FS_BATCH_BEGIN_TAG):
+        get_device().unsupported_tags.add(FS_BATCH_BEGIN_TAG)
+        return False
+
+    return True
+
+
+def fs_batch_end(stream_crc):
+    # Writing out all files of the batch takes a while
+    previous_timeout = set_read_timeout(get_device().fs_timeout)
+    send_request(FS_BATCH_END_TAG, get_uint32_big_bytes(stream_crc))
+    response = wait_response()
+    set_read_timeout(previous_timeout)
+    if not response_verify(response, FS_BATCH_END_TAG):
+        log.die('fs_batch_end failed!')
+
+
 def mkdir(path, nouse):
     payload = bytes(path, 'utf-8') + b'\x00'
     send_request(FS_MKDIR_TAG, payload)
@@ -450,8 +1307,9 @@ def mkdir(path, nouse):
 
 
 def rm(path):
-    previous_timeout = SERIAL_PORT.timeout
-    SERIAL_PORT.timeout = SERIAL_PORT_FS_TIMEOUT
+    device = get_device()
+    previous_timeout = device.port.timeout
+    device.port.timeout = device.fs_timeout
 
     log.inf('Deleteing ' + str(path))
     payload = bytes(path, 'utf-8') + b'\x00'
@@ -464,40 +1322,537 @@ def rm(path):
     else:
         log.inf('Deletion of the ' + path + ' was successful')
 
-    SERIAL_PORT.timeout = previous_timeout
+    device.port.timeout = previous_timeout
 
 
 
 
-def cp(src, dst):
-    payload = bytes(dst, 'utf-8') + b'\x00'
-    log.inf('Copying ' + src + ' to ' + dst)
-    log.dbg(list(payload))
-    f = Path(src)
+def get_data_window(tag, device = None):
+    if device is None:
+        device = get_device()
+    window = DATA_WINDOW_SIZE if device.window_size is None else max(1, min(DATA_WINDOW_SIZE, device.window_size))
 
-    if not f.is_file():
-        log.die('Open file ' + str(f) + ' failed!')
+    return device.data_window.get(tag, window)
 
-    file_length = f.stat().st_size
-    file_bytes = f.read_bytes()
-    file_crc = crc32(file_bytes)
-    process_bar = tqdm(total=file_length, unit='B', unit_scale=True)
 
-    fs_file_begin(file_length, dst)
+def get_payload_length(device = None):
+    if device is None:
+        device = get_device()
 
-    offset = 0
-    while offset < file_length:
-        payload = file_bytes[offset : offset + MAX_PAYLOAD_LENGTH]
-        offset += MAX_PAYLOAD_LENGTH
-        fs_file_data(payload)
-        process_bar.update(len(payload))
+    return min(MAX_PAYLOAD_LENGTH, device.payload_length)
 
-    process_bar.close()
+
+def get_data_timeout(window, payload_length):
+    # Every frame in flight may be ahead of the response waited for. The
+    # read timeout stays the floor, a flash erase or an SD card stall can
+    # hold up a single frame for seconds
+    device = get_device()
+    wire_time = window * (FRAME_OVERHEAD + payload_length) * 10 / device.baudrate
+
+    return device.read_timeout + 2 * wire_time
+
+
+def set_read_timeout(timeout):
+    port = get_device().port
+    previous_timeout = port.timeout
+    port.timeout = timeout
+
+    return previous_timeout
+
+
+def choose_transfer_strategy():
+    # Called whenever the link changes: after the baud rate is set and once
+    # the serial loader reported its capabilities
+    device = get_device()
+    capabilities = device.capabilities
+
+    device.window_size = capabilities['rx_frames']
+    payload_length = MAX_PAYLOAD_LENGTH
+    if capabilities['max_payload'] is not None:
+        payload_length = max(1, min(payload_length, capabilities['max_payload']))
+
+    if get_data_window(None) == 1 and device.sync_rtt is not None:
+        # A USB CDC device answers within a USB frame while a UART bridge adds
+        # its own latency, so the frame size follows the measured round trip
+        byte_time = 10 / device.baudrate
+        needed = int(device.sync_rtt * FRAME_RTT_RATIO / byte_time)
+        length = MIN_PAYLOAD_LENGTH
+        while length < needed:
+            length *= 2
+        payload_length = min(payload_length, length)
+
+    device.payload_length = payload_length
+    log.dbg(get_label() + 'Frame payload ' + str(payload_length) + ' bytes, window ' + str(get_data_window(None)) +
+            ', sync round trip ' + ('unknown' if device.sync_rtt is None else '{:.2f}ms'.format(device.sync_rtt * 1000)))
+
+
+def is_tag_supported(tag):
+    device = get_device()
+    tags = device.capabilities['tags']
+
+    if tags is None:
+        tags = BASE_TAGS
+
+    return tag not in device.unsupported_tags and tag in tags
+
+
+def get_label():
+    label = get_device().label
+
+    return '' if label is None else label + ': '
+
+
+def get_process_bar(total):
+    device = get_device()
+
+    return tqdm(total=total, unit='B', unit_scale=True, desc=device.label, position=device.position)
+
+
+def compress_payload(payload):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+
+    return compressor.compress(payload) + compressor.flush()
+
+
+def read_payload(file, payload):
+    length = 0
+    while length < len(payload):
+        count = file.readinto(payload[length:])
+        if not count:
+            break
+        length += count
+
+    return length
+
+
+def send_data_frames(tag, file, file_length, process_bar = None):
+    # Each payload is read straight into the request frame buffer, so at most
+    # one frame of the file is held in memory. Returns the CRC32 of the data
+    # sent, or None if a frame failed more than FRAME_RETRIES times or the
+    # transfer cannot be resumed
+    device = get_device()
+    window = get_data_window(tag)
+    max_length = get_payload_length()
+    compress = COMPRESSION and 'deflate' in device.loader_features and tag in COMPRESSION_TAGS
+
+    file.seek(0)
+    previous_timeout = set_read_timeout(get_data_timeout(window, max_length))
+    try:
+        return send_frames(tag, file, file_length, process_bar, window, max_length, compress)
+    finally:
+        device.port.timeout = previous_timeout
+
+
+class FrameWindow:
+    '''Frames in flight of one data transfer, with their retries and resume.
+
+    Shared by send_frames() and serial_download_async, the caller reads and
+    sends the frames, receive() has to run where the port is used.
+    '''
+
+    def __init__(self, tag, file_length, window, process_bar = None, device = None):
+        self.device = get_device() if device is None else device
+        self.tag = tag
+        self.file_length = file_length
+        self.window = window
+        self.process_bar = process_bar
+        self.in_flight = deque()
+        self.retries = 0
+        self.sequence = 0
+        # Where the next frame starts and the CRC32 of everything before it
+        self.offset = 0
+        self.file_crc = 0
+        # Set when a resume moved offset back, the frames read ahead are void
+        self.resumed = False
+
+    def is_done(self):
+        return self.offset >= self.file_length and len(self.in_flight) == 0
+
+    def can_send(self):
+        return self.offset < self.file_length and len(self.in_flight) < self.window
+
+    def sent(self, length, file_crc):
+        # file_crc includes the frame just sent
+        device = self.device
+        if device.timing is not None and device.first_data_frame is None:
+            device.first_data_frame = monotonic()
+        self.in_flight.append((self.sequence, length, monotonic(), self.offset, self.file_crc))
+        self.sequence += 1
+        self.offset += length
+        self.file_crc = file_crc
+
+    def receive(self):
+        # Responses come back in request order, so the oldest frame in flight
+        # is the one being acknowledged. False if the transfer failed
+        device = self.device
+        done_sequence, done_length, sent_time, done_offset, done_crc = self.in_flight.popleft()
+        response = wait_response()
+        error = get_response_error(response, self.tag)
+        if error is None:
+            self.retries = 0
+            if device.frame_rtt is not None:
+                device.frame_rtt.append(monotonic() - sent_time)
+            if self.process_bar is not None:
+                self.process_bar.update(done_length)
+            return True
+
+        log.dbg('data frame ' + str(done_sequence) + ' failed (' + error + '), ' + str(len(self.in_flight)) + ' frames still in flight')
+        count_link_error(error, device)
+        self.retries += 1
+        if self.retries > FRAME_RETRIES:
+            return False
+
+        # The transfer goes on from a frame boundary the device reached, with
+        # the CRC of everything before it
+        boundaries = {done_offset: done_crc, self.offset: self.file_crc}
+        for entry in self.in_flight:
+            boundaries[entry[3]] = entry[4]
+        position = get_resume_position(error, done_offset, len(self.in_flight) > 0)
+        if position not in boundaries:
+            return False
+
+        count_link_error('resent', device)
+        if self.process_bar is not None:
+            self.process_bar.update(position - done_offset)
+        self.in_flight.clear()
+        self.offset = position
+        self.file_crc = boundaries[position]
+        self.resumed = True
+
+        return True
+
+
+def send_frames(tag, file, file_length, process_bar, window, max_length, compress):
+    frames = FrameWindow(tag, file_length, window, process_bar)
+
+    while not frames.is_done():
+        if not frames.can_send():
+            if not frames.receive():
+                return None
+            if frames.resumed:
+                frames.resumed = False
+                file.seek(frames.offset)
+            continue
+
+        payload = get_request_payload(min(max_length, file_length - frames.offset))
+        if read_payload(file, payload) != len(payload):
+            log.die('read ' + file.name + ' failed, the file was changed during the transfer')
+        payload_length = len(payload)
+        file_crc = crc32(payload, frames.file_crc)
+
+        # The frame CRC covers the compressed bytes, the CRC sent with the
+        # end request is still the one of the file
+        request_tag = tag
+        if compress:
+            compressed = compress_payload(payload)
+            if len(compressed) < payload_length:
+                payload = compressed
+                request_tag = tag | DATA_DEFLATE_FLAG
+
+        send_request(request_tag, payload)
+        frames.sent(payload_length, file_crc)
+
+    return frames.file_crc
+
+
+def send_data(tag, file, file_length, begin, process_bar = None):
+    while True:
+        if begin() == False:
+            return None
+        file_crc = send_data_frames(tag, file, file_length, process_bar)
+        if file_crc is not None:
+            return file_crc
+
+        count_link_error('restarted')
+        if get_data_window(tag) > 1:
+            # The device could not keep up with pipelined frames, restart the
+            # whole transfer in stop-and-wait mode
+            log.wrn(get_label() + 'Pipelined transfer failed, falling back to stop-and-wait mode')
+            get_device().data_window[tag] = 1
+            if not sync(reset_output = False):
+                return None
+        elif not lower_baudrate():
+            return None
+
+        if process_bar is not None:
+            process_bar.reset()
+
+
+def send_file(f, tag, begin, process_bar = None):
+    file_length = f.stat().st_size
+
+    with f.open('rb', buffering=0) as file:
+        return send_data(tag, file, file_length, lambda: begin(file_length), process_bar)
+
+
+
+
+def cp(src, dst):
+    payload = bytes(dst, 'utf-8') + b'\x00'
+    log.inf('Copying ' + src + ' to ' + dst)
+    log.dbg(list(payload))
+    f = Path(src)
+
+    if not f.is_file():
+        log.die('Open file ' + str(f) + ' failed!')
+
+    file_length = f.stat().st_size
+    process_bar = get_process_bar(file_length)
+
+    file_crc = send_file(f, FS_FILE_DATA_TAG, lambda length: fs_file_begin(length, dst), process_bar)
+    if file_crc is None:
+        log.die('fs_file_data failed!')
+
+    process_bar.close()
     fs_file_end(file_crc)
 
 
 
 
+def fs_write_file(data, dst):
+    file = io.BytesIO(data)
+    file.name = dst
+
+    file_crc = send_data(FS_FILE_DATA_TAG, file, len(data), lambda: fs_file_begin(len(data), dst))
+    if file_crc is None:
+        log.die('fs_file_data failed!')
+
+    fs_file_end(file_crc)
+
+
+def get_batch_record(kind, path, data = b''):
+    path = bytes(path, 'utf-8')
+
+    return BATCH_RECORD.pack(kind, len(path), len(data)) + path + data
+
+
+def copy_batch(entries, dirs):
+    # entries are (destination, data) pairs, dirs holds the directories
+    # created by earlier batches of the same copy. False if the loader
+    # refused the batch and nothing was sent
+    stream = bytearray()
+    for dst, data in entries:
+        for parent in reversed(Path(dst).parents):
+            # Skip / and the volume
+            if len(parent.parts) > 2 and str(parent) not in dirs:
+                dirs.add(str(parent))
+                stream += get_batch_record(BATCH_DIR, str(parent))
+        log.dbg('Packing ' + dst)
+        stream += get_batch_record(BATCH_FILE, dst, data)
+
+    directory = os.path.commonpath([os.path.dirname(dst) for dst, data in entries])
+    log.inf('Copying ' + str(len(entries)) + (' file' if len(entries) == 1 else ' files') + ' to ' + directory)
+    file = io.BytesIO(stream)
+    file.name = 'the batch'
+    process_bar = get_process_bar(len(stream))
+
+    stream_crc = send_data(FS_BATCH_DATA_TAG, file, len(stream), lambda: fs_batch_begin(len(stream)), process_bar)
+    process_bar.close()
+    if stream_crc is None and not is_tag_supported(FS_BATCH_BEGIN_TAG):
+        log.wrn(get_label() + 'The serial loader refused a batched copy, copying the files one by one')
+        return False
+    if stream_crc is None:
+        log.die('fs_batch_data failed!')
+
+    fs_batch_end(stream_crc)
+    return True
+
+
+def send_batch(entries, dirs):
+    # Falls back to one file at a time, False if later files must not be
+    # batched either
+    if copy_batch(entries, dirs):
+        return True
+
+    for dst, data in entries:
+        log.inf('Copying ' + dst)
+        fs_write_file(data, dst)
+
+    return False
+
+
+def get_file_hash(f):
+    file_hash = hashlib.sha256()
+    with f.open('rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_LENGTH), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def prepare_copy_file(f):
+    # Runs in a worker, small files are read once for both the hash and the
+    # batch they are sent in
+    if not f.is_file():
+        log.die('Open file ' + str(f) + ' failed!')
+
+    if f.stat().st_size > BATCH_FILE_LENGTH:
+        return {'size': f.stat().st_size, 'sha256': get_file_hash(f)}, None
+
+    data = f.read_bytes()
+
+    return {'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()}, data
+
+
+def prepare_copy_files(files):
+    # Yields (file, manifest entry, data) in order while a thread pool reads
+    # and hashes the next COPY_PREPARE_AHEAD files, so the link does not wait
+    # for the disk
+    with ThreadPoolExecutor(max_workers=COPY_PREPARE_WORKERS) as executor:
+        pending = deque()
+        for file in files:
+            pending.append((file, executor.submit(prepare_copy_file, file)))
+            if len(pending) > COPY_PREPARE_AHEAD:
+                file, future = pending.popleft()
+                yield (file,) + future.result()
+
+        while len(pending) > 0:
+            file, future = pending.popleft()
+            yield (file,) + future.result()
+
+
+def get_board_key():
+    serial_number = get_port_serial_number()
+
+    return serial_number if serial_number is not None else get_device().port.port
+
+
+def get_device_manifest_path(root):
+    # One manifest per copy destination, e.g. /SD:/.mm/<hash of /SD:/Resources>.json
+    volume = '/' + root.split('/')[1]
+
+    return volume + '/' + MANIFEST_DIR + '/' + hashlib.sha256(root.encode('utf-8')).hexdigest()[:16] + '.json'
+
+
+def load_device_manifest(root):
+    if not is_tag_supported(FS_READ_TAG):
+        return None
+
+    path = get_device_manifest_path(root)
+
+    data = fs_read_file(path)
+    if data is None or len(data) == 0:
+        return None
+
+    try:
+        manifest = json.loads(data.decode('utf-8'))
+    except ValueError:
+        log.wrn(get_label() + 'Ignoring the broken manifest ' + path)
+        return None
+
+    if not isinstance(manifest, dict) or manifest.get('root') != root:
+        return None
+
+    return manifest.get('files')
+
+
+def read_local_manifests(manifest_path):
+    try:
+        return json.loads(manifest_path.read_text(encoding='UTF-8'))
+    except (OSError, ValueError):
+        return {}
+
+
+def load_local_manifest(manifest_path, root):
+    # The local manifest holds one entry per board and copy destination
+    with CACHE_LOCK:
+        return read_local_manifests(manifest_path).get(get_board_key(), {}).get(root)
+
+
+def save_local_manifest(manifest_path, root, files):
+    with CACHE_LOCK:
+        manifests = read_local_manifests(manifest_path)
+        manifests.setdefault(get_board_key(), {})[root] = files
+        try:
+            manifest_path.parent.mkdir(parents=True, exist_ok=True)
+            manifest_path.write_text(json.dumps(manifests, indent=2), encoding='UTF-8')
+        except OSError:
+            log.wrn('cannot write ' + str(manifest_path))
+
+
+def get_previous_manifest(root, manifest_path):
+    # The manifest of the last copy is kept on the device, outside the copied
+    # tree. manifest_path is only used if the device cannot read files back,
+    # a device without a manifest may have been wiped or be another board
+    if not INCREMENTAL_COPY:
+        return None
+
+    previous = load_device_manifest(root)
+    if is_tag_supported(FS_READ_TAG) or manifest_path is None:
+        return previous
+
+    # Without a serial number the local manifest is kept per port, another
+    # board on the same port would silently keep stale files
+    if get_port_serial_number() is None and not TRUST_LOCAL_MANIFEST:
+        log.inf(get_label() + 'The board has no serial number, copying every file')
+        return None
+
+    return load_local_manifest(manifest_path, root)
+
+
+def copy_changed_files(delete, source, destination, files, manifest_path):
+    # Sends the files whose size or SHA-256 differ from the manifest of the
+    # last copy while the next ones are hashed, everything if there is none
+    root = str(destination / source)
+    previous = get_previous_manifest(root, manifest_path)
+
+    if previous is None:
+        if delete:
+            rm(root)
+        manifest = {}
+        removed = []
+    elif delete:
+        manifest = {}
+        destinations = set(str(destination / file) for file in files)
+        removed = [path for path in previous if path not in destinations]
+        for path in removed:
+            rm(path)
+    else:
+        # Files merged in by earlier copies stay on the device
+        manifest = dict(previous)
+        removed = []
+
+    batching = BATCH_COPY and 'batch' in get_device().loader_features and is_tag_supported(FS_BATCH_BEGIN_TAG)
+    dirs = set()
+    batch = []
+    batch_length = 0
+    changed = 0
+    for file, entry, data in prepare_copy_files(files):
+        dst = str(destination / file)
+        manifest[dst] = entry
+        if previous is not None and previous.get(dst) == entry:
+            continue
+
+        changed += 1
+        if not batching or data is None:
+            cp(str(file), dst)
+            continue
+        if len(batch) > 0 and batch_length + len(data) > BATCH_LENGTH:
+            batching = send_batch(batch, dirs)
+            batch = []
+            batch_length = 0
+        if not batching:
+            fs_write_file(data, dst)
+            continue
+        batch.append((dst, data))
+        batch_length += len(data)
+
+    if len(batch) > 0:
+        send_batch(batch, dirs)
+
+    if previous is not None:
+        log.inf(get_label() + str(changed) + ' of ' + str(len(files)) + ' files changed, ' + str(len(removed)) + ' removed')
+    save_copy_manifest(root, manifest, manifest_path)
+
+
+def save_copy_manifest(root, manifest, manifest_path):
+    if is_tag_supported(FS_READ_TAG):
+        log.dbg('Writing the manifest of ' + root)
+        fs_write_file(json.dumps({'root': root, 'files': manifest}, indent=1).encode('utf-8'), get_device_manifest_path(root))
+    if manifest_path is not None:
+        save_local_manifest(manifest_path, root, manifest)
+
+
 def send_file2mem(file_name, addr, bar=False):
     f = Path(file_name)
 
@@ -505,20 +1860,13 @@ def send_file2mem(file_name, addr, bar=False):
         log.die('open file ' + str(f) + ' failed!')
 
     file_length = f.stat().st_size
-    file_bytes = f.read_bytes()
-    file_crc = crc32(file_bytes)
+    process_bar = None
     if bar:
-        process_bar = tqdm(total=file_length, unit='B', unit_scale=True)
-
-    mem_begin(addr, file_length)
+        process_bar = get_process_bar(file_length)
 
-    offset = 0
-    while offset < file_length:
-        payload = file_bytes[offset : offset + MAX_PAYLOAD_LENGTH]
-        offset += MAX_PAYLOAD_LENGTH
-        mem_data(payload)
-        if bar:
-            process_bar.update(len(payload))
+    file_crc = send_file(f, RAM_DATA_TAG, lambda length: mem_begin(addr, length), process_bar)
+    if file_crc is None:
+        log.die('mem_data failed')
 
     if bar:
         process_bar.close()
@@ -532,18 +1880,11 @@ def send_file2flash(file_name, addr, run_addr):
         log.die('open file ' + str(f) + ' failed!')
 
     file_length = f.stat().st_size
-    file_bytes = f.read_bytes()
-    file_crc = crc32(file_bytes)
-    process_bar = tqdm(total=file_length, unit='B', unit_scale=True)
-
-    flash_begin(addr, file_length)
+    process_bar = get_process_bar(file_length)
 
-    offset = 0
-    while offset < file_length:
-        payload = file_bytes[offset : offset + MAX_PAYLOAD_LENGTH]
-        offset += MAX_PAYLOAD_LENGTH
-        flash_data(payload)
-        process_bar.update(len(payload))
+    file_crc = send_file(f, FLASH_DATA_TAG, lambda length: flash_begin(addr, length), process_bar)
+    if file_crc is None:
+        log.die('flash_data failed!')
 
     process_bar.close()
     flash_end(file_crc, run_addr)
@@ -556,92 +1897,525 @@ def send_file2sdcard(file_name, target_name):
         log.die('open file ' + str(f) + ' failed!')
 
     file_length = f.stat().st_size
-    file_bytes = f.read_bytes()
-    file_crc = crc32(file_bytes)
-    process_bar = tqdm(total=file_length, unit='B', unit_scale=True)
-
-    sdcard_begin(file_length, target_name)
-
-    offset = 0
-    while offset < file_length:
-        payload = file_bytes[offset : offset + MAX_PAYLOAD_LENGTH]
-        offset += MAX_PAYLOAD_LENGTH
-        sdcard_data(payload)
-        process_bar.update(len(payload))
-    
+    process_bar = get_process_bar(file_length)
+
+    file_crc = send_file(f, FS_DATA_TAG, lambda length: sdcard_begin(length, target_name), process_bar)
+    if file_crc is None:
+        log.die('sdcard_data failed!')
+
     process_bar.close()
     sdcard_end(file_crc)
 
 
+def get_block_crcs(data, block_size):
+    return [crc32(data[start : start + block_size]) for start in range(0, len(data), block_size)]
+
+
+def read_remote_crcs(kind, target, offset, length):
+    # Block CRCs of a range on the device computed from the data read back,
+    # files also return their size. The responses carry one frame of data
+    read_length = max(1, get_payload_length() - 4)
+    size = None
+    data = bytearray()
+    while len(data) < length or (size is None and kind == 'file'):
+        start = offset + len(data)
+        count = min(read_length, length - len(data))
+        if kind == 'partition':
+            chunk = partion_read(target, start, count)
+        else:
+            result = fs_file_read(target, start, count)
+            size, chunk = (None, None) if result is None else result
+        if chunk is None:
+            return None
+        data += chunk
+        if len(chunk) < count or count == 0:
+            break
+
+    return size, get_block_crcs(data, VERIFY_BLOCK_SIZE)
+
+
+def get_remote_crcs(kind, target, offset, length):
+    # Block CRCs of a range on the device, and the size of a file, hashed by
+    # the loader when it can or read back. None if it can do neither
+    hash_tag, read_tag = (VERIFY_TAG, READ_TAG) if kind == 'partition' else (FS_VERIFY_TAG, FS_READ_TAG)
+
+    if is_tag_supported(hash_tag):
+        if kind == 'partition':
+            block_crcs = partion_verify(target, offset, length, VERIFY_BLOCK_SIZE)
+            result = None if block_crcs is None else (None, block_crcs)
+        else:
+            result = fs_file_verify(target, offset, length, VERIFY_BLOCK_SIZE)
+        if result is not None:
+            return result
+
+        log.dbg('The serial loader cannot hash ' + target + ', reading it back')
+        get_device().unsupported_tags.add(hash_tag)
+
+    if not is_tag_supported(read_tag):
+        return None
+
+    result = read_remote_crcs(kind, target, offset, length)
+    if result is None:
+        get_device().unsupported_tags.add(read_tag)
+
+    return result
+
+
+def get_first_difference(f, kind, target, process_bar = None):
+    # Streams the local image against the partition or file on the device, a
+    # chunk at a time. Returns (verified, offset), offset is where the first
+    # differing block starts or None if both are identical
+    file_length = f.stat().st_size
+
+    with f.open('rb', buffering=0) as file:
+        offset = 0
+        while offset < file_length or (offset == 0 and kind == 'file'):
+            length = min(VERIFY_CHUNK_LENGTH, file_length - offset)
+            result = get_remote_crcs(kind, target, offset, length)
+            if result is None:
+                return False, None
+            size, remote_crcs = result
+            if size is not None and size != file_length:
+                return True, min(size, file_length)
+
+            local_crcs = get_block_crcs(file.read(length), VERIFY_BLOCK_SIZE)
+            for index in range(len(local_crcs)):
+                if index >= len(remote_crcs) or local_crcs[index] != remote_crcs[index]:
+                    return True, offset + index * VERIFY_BLOCK_SIZE
+
+            offset += length
+            if process_bar is not None:
+                process_bar.update(length)
+            if length == 0:
+                break
+
+    return True, None
+
+
+def is_identical(f, kind, target):
+    verified, offset = get_first_difference(f, kind, target)
+    if not verified:
+        log.wrn(get_label() + 'The serial loader cannot read back ' + target + ', writing it anyway')
+        return False
+    if offset is not None:
+        return False
+
+    log.inf(get_label() + target + ' already holds ' + f.name + ', skipped')
+    return True
+
+
 def send_file2partion(file_name, partition_name):
     f = Path(file_name)
 
     if not f.is_file():
         log.die('open file ' + str(f) + ' failed!')
 
-    file_length = f.stat().st_size
-    file_bytes = f.read_bytes()
-    file_crc = crc32(file_bytes)
-    process_bar = tqdm(total=file_length, unit='B', unit_scale=True)
+    if DELTA_UPDATE and send_file2partion_delta(f, partition_name):
+        return
 
-    partion_begin(partition_name, file_length)
+    file_length = f.stat().st_size
+    process_bar = get_process_bar(file_length)
 
-    offset = 0
-    while offset < file_length:
-        payload = file_bytes[offset : offset + MAX_PAYLOAD_LENGTH]
-        offset += MAX_PAYLOAD_LENGTH
-        partion_data(payload)
-        process_bar.update(len(payload))
+    file_crc = send_file(f, PARTION_DATA_TAG, lambda length: partion_begin(partition_name, length), process_bar)
+    if file_crc is None:
+        log.die('partion_data failed!')
 
     process_bar.close()
     partion_end(file_crc)
 
 
-def get_board_info():
+def get_info():
     send_request(INFO_TAG)
     response = wait_response()
-
     if not response_verify(response, INFO_TAG):
-        log.die('get board info failed')
+        return None
 
-    payload = response_get_payload(response)
-    info = payload.decode('utf-8')
-    log.inf('Board info: ' + info)
+    return bytes(response_get_payload(response)).decode('utf-8', 'replace')
 
 
-def get_rom_version():
+def get_version():
     send_request(VERSION_TAG)
     response = wait_response()
-
     if not response_verify(response, VERSION_TAG):
-        log.die('get ROM version failed')
+        return None
 
     payload = response_get_payload(response)
-    major = str(payload[1])
-    minor = str(payload[2])
-    patch = str(payload[3])
-    log.inf('ROM_Version: ' + major + '.' + minor + '.' + patch)
+    if len(payload) < 4:
+        return None
+
+    return (payload[1], payload[2], payload[3])
+
+
+def get_rom_capabilities():
+    # The ROM INFO string may carry the same key=value pairs as the loader's,
+    # e.g. a max_baudrate that keeps negotiate_baudrate() off faster rates
+    device = get_device()
+
+    info = get_info()
+    device.capabilities = get_capabilities(info if info is not None else '', get_version())
+    if info is None:
+        device.capabilities['info'] = None
+    log.dbg('ROM capabilities: ' + str(device.capabilities))
+
+    return device.capabilities
+
+
+def get_board_info():
+    info = get_device().capabilities['info']
+    if info is None:
+        log.die(get_label() + 'get board info failed')
+
+    log.inf(get_label() + 'Board info: ' + info)
+
+
+def get_loader_features():
+    device = get_device()
+
+    # A loader advertises optional protocol features, limits and properties
+    # in its INFO string, e.g. 'SerialLoader 1.1; features=deflate,delta; loader_crc=1a2b3c4d'
+    info = get_info()
+    device.capabilities = get_capabilities(info if info is not None else '', get_version())
+    device.unsupported_tags = set()
+    device.loader_properties = device.capabilities['properties']
+    device.loader_features = device.capabilities['features']
+    choose_transfer_strategy()
+
+    log.dbg('Serial loader capabilities: ' + str(device.capabilities))
+    return device.loader_features
+
+
+def get_file_crc(file_name):
+    file_crc = 0
+    with open(file_name, 'rb') as file:
+        for chunk in iter(lambda: file.read(MAX_PAYLOAD_LENGTH), b''):
+            file_crc = crc32(chunk, file_crc)
+
+    return file_crc
+
+
+def read_loader_states():
+    try:
+        return json.loads(LOADER_STATE.read_text(encoding='UTF-8'))
+    except (OSError, ValueError):
+        return {}
+
+
+def write_loader_states(states):
+    try:
+        LOADER_STATE.parent.mkdir(parents=True, exist_ok=True)
+        LOADER_STATE.write_text(json.dumps(states, indent=2), encoding='UTF-8')
+    except OSError:
+        log.dbg('cannot write ' + str(LOADER_STATE))
+
+
+def load_loader_state():
+    # The loader state file holds one entry per port
+    with CACHE_LOCK:
+        return read_loader_states().get(get_device().port.port)
+
+
+def save_loader_state():
+    device = get_device()
+    state = {
+        'serial_number': get_port_serial_number(),
+        'baudrate': device.baudrate,
+        'loader_crc': None if device.loader_crc is None else '{:08x}'.format(device.loader_crc),
+        'loader_info': device.capabilities['info'],
+        'time': time()
+    }
+    with CACHE_LOCK:
+        states = read_loader_states()
+        states[device.port.port] = state
+        write_loader_states(states)
+
+
+def clear_loader_state():
+    with CACHE_LOCK:
+        states = read_loader_states()
+        if states.pop(get_device().port.port, None) is not None:
+            write_loader_states(states)
+
+
+def reuse_serial_loader():
+    # Only probe a board that a previous --keep-loader session left running,
+    # anything else goes through the normal reset and bootstrap
+    state = load_loader_state()
+    if state is None:
+        return False
+    if state.get('serial_number') != get_port_serial_number():
+        return False
+
+    change_host_baud(state.get('baudrate', SERIAL_INIT_BAUDRATE))
+    if sync(2) == False:
+        clear_loader_state()
+        change_host_baud(SERIAL_INIT_BAUDRATE)
+        return False
+
+    get_loader_features()
+    # A loader that reports its own CRC is checked against the file, a stock
+    # one is trusted to be what this host uploaded and recorded if it still
+    # introduces itself the same way, a board reset into its ROM does not
+    device = get_device()
+    loader = util.get_tool_path('serial-loader')
+    loader_crc = device.loader_properties.get('loader_crc')
+    if loader_crc is None and device.capabilities['info'] == state.get('loader_info'):
+        loader_crc = state.get('loader_crc')
+    file_crc = get_file_crc(loader)
+    if loader_crc is None or loader_crc.lower() != '{:08x}'.format(file_crc):
+        log.inf('The running serial loader does not match ' + loader.name + ', restarting')
+        clear_loader_state()
+        change_host_baud(SERIAL_INIT_BAUDRATE)
+        return False
+    device.loader_crc = file_crc
+
+    log.inf(get_label() + 'Reusing the serial loader running at ' + str(get_device().baudrate) + ' baud')
+    return True
+
+
+def open_serial_loader(board_info = False, rom_version = False):
+    with timing_phase('reuse loader'):
+        if reuse_serial_loader():
+            return
+
+    with timing_phase('reset'):
+        # A held port may still be at the rate of the last command, the
+        # board comes out of reset at the initial one
+        change_host_baud(SERIAL_INIT_BAUDRATE)
+        reset_to_download()
+    with timing_phase('sync'):
+        if sync() == False:
+            log.die("Sync failed!")
+
+    with timing_phase('capabilities'):
+        get_rom_capabilities()
+
+    with timing_phase('baud rate'):
+        negotiate_baudrate()
+        choose_transfer_strategy()
+
+    if board_info:
+        get_board_info()
+    if rom_version:
+        get_rom_version()
+
+    with timing_phase('loader'):
+        start_serial_loader()
+
+
+def finish_serial_loader():
+    with timing_phase('finish'):
+        if KEEP_LOADER:
+            save_loader_state()
+            log.inf(get_label() + 'Serial loader kept running at ' + str(get_device().baudrate) + ' baud')
+        else:
+            reboot()
+            clear_loader_state()
+
+        deinit_serial_device()
+
+    print_link_errors()
+    record_metrics()
+    print_timing()
+
+
+def start_serial_loader():
+    serial_loader = util.get_tool_path('serial-loader')
+    send_file2mem(serial_loader, 0x00000000)
+    execute(0x00000000)
+    get_device().loader_crc = get_file_crc(serial_loader)
+    sleep(LOADER_START_TIME)
+
+    # The loader answers SYNC once it is running
+    if sync() == False:
+        log.die("Sync failed!")
+
+    get_loader_features()
+
+
+def get_rom_version():
+    version = get_device().capabilities['version']
+    if version is None:
+        log.die(get_label() + 'get ROM version failed')
+
+    log.inf(get_label() + 'ROM_Version: ' + '.'.join(str(number) for number in version))
 
 def change_host_baud(new_baud):
-    SERIAL_PORT.baudrate = new_baud
-    sleep(0.01)
-    SERIAL_PORT.reset_output_buffer()
-    SERIAL_PORT.reset_input_buffer()
+    device = get_device()
 
+    device.baudrate = new_baud
+    if CAPTURE is not None:
+        CAPTURE.record_baudrate(new_baud)
+    device.port.baudrate = new_baud
+    device.port.reset_output_buffer()
+    reset_input(device)
+
+
+def change_baudrate(new_baud):
+    device = get_device()
 
-def sync_baud(new_baud):
     payload = get_uint32_big_bytes(new_baud)
 
-    SERIAL_PORT.reset_output_buffer()
-    SERIAL_PORT.reset_input_buffer()
+    device.port.reset_output_buffer()
+    reset_input(device)
     send_request(CHANGE_BAUDRATE_TAG, payload)
     response = wait_response()
     if not response_verify(response, CHANGE_BAUDRATE_TAG):
+        return False
+    try:
+        device.port.baudrate = new_baud
+    except (serial.SerialException, ValueError) as e:
+        # Not every USB serial bridge or driver takes every rate
+        log.wrn(get_label() + 'The serial port cannot run at ' + str(new_baud) + ' baud: ' + str(e))
+        return False
+    if CAPTURE is not None:
+        CAPTURE.record_baudrate(new_baud)
+    device.baudrate = new_baud
+    device.port.reset_output_buffer()
+    reset_input(device)
+
+    return True
+
+
+def sync_baud(new_baud):
+    if not change_baudrate(new_baud):
         log.die('modify baudrate to ' + str(new_baud) + ' failed!')
-    SERIAL_PORT.baudrate = new_baud
-    sleep(0.01)
-    SERIAL_PORT.reset_output_buffer()
-    SERIAL_PORT.reset_input_buffer()
+
+
+def request(tag, payload = None):
+    send_request(tag, payload)
+    response = wait_response()
+
+    return response_verify(response, tag)
+
+
+def get_port_serial_number():
+    # Looked up when the port was opened
+    return get_device().serial_number
+
+
+def load_baudrate_cache():
+    try:
+        return json.loads(BAUDRATE_CACHE.read_text(encoding='UTF-8'))
+    except (OSError, ValueError):
+        return {}
+
+
+def get_cached_baudrate(board_key):
+    entry = load_baudrate_cache().get(board_key)
+    if entry is None or time() - entry.get('time', 0) > BAUDRATE_CACHE_EXPIRE:
+        return None
+
+    return entry.get('baudrate')
+
+
+def save_cached_baudrate(board_key, baudrate):
+    with CACHE_LOCK:
+        cache = load_baudrate_cache()
+        cache[board_key] = {'baudrate': baudrate, 'time': time()}
+        try:
+            BAUDRATE_CACHE.parent.mkdir(parents=True, exist_ok=True)
+            BAUDRATE_CACHE.write_text(json.dumps(cache, indent=2), encoding='UTF-8')
+        except OSError:
+            log.dbg('cannot write ' + str(BAUDRATE_CACHE))
+
+
+def probe_baudrate(baudrate):
+    # Switch to the rate and push a short RAM transfer through the ROM
+    if not change_baudrate(baudrate) or not sync(3):
+        return False
+
+    data = os.urandom(BAUDRATE_PROBE_LENGTH)
+    payload = get_uint64_big_bytes(BAUDRATE_PROBE_ADDRESS) + get_uint32_big_bytes(len(data))
+
+    return (request(RAM_BEGIN_TAG, payload) and
+            request(RAM_DATA_TAG, data) and
+            request(RAM_END_TAG, get_uint32_big_bytes(crc32(data))))
+
+
+def restart_download_mode():
+    change_host_baud(SERIAL_INIT_BAUDRATE)
+    reset_to_download()
+    if sync() == False:
+        log.die("Sync failed!")
+
+
+def negotiate_baudrate():
+    if TARGET_BAUDRATE is not None:
+        sync_baud(TARGET_BAUDRATE)
+        if sync() == False:
+            log.die("Sync failed!")
+        return TARGET_BAUDRATE
+
+    board_key = get_board_key()
+    cached = get_cached_baudrate(board_key)
+
+    candidates = list(BAUDRATE_LADDER)
+    max_baudrate = get_device().capabilities['max_baudrate']
+    if max_baudrate is not None:
+        candidates = [baudrate for baudrate in candidates if baudrate <= max_baudrate] or candidates[-1:]
+    if cached in candidates:
+        start = candidates.index(cached)
+    else:
+        start = next((index for index, baudrate in enumerate(candidates) if baudrate <= BAUDRATE_START), len(candidates) - 1)
+
+    # Down from the start until a rate works
+    baudrate = None
+    for index in range(start, len(candidates)):
+        if index > start:
+            log.wrn(get_label() + str(candidates[index - 1]) + ' baud is not reliable, trying ' + str(candidates[index]))
+        if try_baudrate(candidates[index], index > start):
+            baudrate = candidates[index]
+            break
+    if baudrate is None:
+        log.die('No reliable baud rate found!')
+
+    # Up from a start rate that worked, a remembered rate is not exceeded
+    if cached not in candidates and baudrate == candidates[start]:
+        for index in range(start - 1, -1, -1):
+            if not try_baudrate(candidates[index], False):
+                # The board is left at the failed rate
+                restart_download_mode()
+                if not probe_baudrate(baudrate):
+                    log.die('No reliable baud rate found!')
+                break
+            baudrate = candidates[index]
+
+    log.inf(get_label() + 'Using ' + str(baudrate) + ' baud')
+    save_cached_baudrate(board_key, baudrate)
+    return baudrate
+
+
+def try_baudrate(baudrate, restart):
+    # Reset the board first if restart is set, and before each further attempt
+    for attempt in range(BAUDRATE_PROBE_ATTEMPTS):
+        if restart or attempt > 0:
+            restart_download_mode()
+        if probe_baudrate(baudrate):
+            return True
+        log.dbg(get_label() + 'Probe at ' + str(baudrate) + ' baud failed')
+
+    return False
+
+
+def lower_baudrate():
+    # Called after a transfer failed in stop-and-wait mode, the device stays
+    # in its current mode so only the rate is changed
+    current_baudrate = get_device().baudrate
+    if TARGET_BAUDRATE is not None or current_baudrate not in BAUDRATE_LADDER:
+        return False
+
+    index = BAUDRATE_LADDER.index(current_baudrate)
+    if index + 1 >= len(BAUDRATE_LADDER):
+        return False
+
+    baudrate = BAUDRATE_LADDER[index + 1]
+    log.wrn(get_label() + 'Transfer failed at ' + str(current_baudrate) + ' baud, falling back to ' + str(baudrate))
+    if not sync() or not change_baudrate(baudrate) or not sync():
+        return False
+
+    save_cached_baudrate(get_board_key(), baudrate)
+
+    return True
 
 
 
@@ -692,147 +2466,140 @@ def test_list_serial_port():
 
 
 def load_to_ram(serial_name, image, address):
-    init_serial_device(serial_name)
+    start_timing('load_to_ram', image)
+    with timing_phase('open'):
+        init_serial_device(serial_name)
+
+    with timing_phase('reset'):
+        # A held port may still be at the rate of the last command, the
+        # board comes out of reset at the initial one
+        change_host_baud(SERIAL_INIT_BAUDRATE)
+        reset_to_download()
+    with timing_phase('sync'):
+        if sync() == False:
+            log.die("Sync failed!")
 
-    reset_to_download()
-    if sync() == False:
-        log.die("Sync failed!")
+    with timing_phase('capabilities'):
+        get_rom_capabilities()
 
-    sync_baud(3000000)
-    if sync() == False:
-        log.die("Sync failed!")
+    with timing_phase('baud rate'):
+        negotiate_baudrate()
+        choose_transfer_strategy()
 
-    send_file2mem(image, address)
+    with timing_phase('transfer'):
+        send_file2mem(image, address)
     execute(address)
+    clear_loader_state()
 
     deinit_serial_device()
+    print_link_errors()
+    record_metrics()
+    print_timing()
 
 
 def load_to_partition(serial_name, image, partition):
-    init_serial_device(serial_name)
+    start_timing('load_to_partition', image)
+    with timing_phase('open'):
+        init_serial_device(serial_name)
 
-    reset_to_download()
-    if sync() == False:
-        log.die("Sync failed!")
+    open_serial_loader(board_info = True, rom_version = True)
 
-    sync_baud(3000000)
-    if sync() == False:
-        log.die("Sync failed!")
+    with timing_phase('transfer'):
+        if not SKIP_IDENTICAL or not is_identical(Path(image), 'partition', partition):
+            send_file2partion(image, partition)
 
-    get_board_info()
-    get_rom_version()
+    with timing_phase('set boot'):
+        partion_set_boot(partition)
 
-    serial_loader = util.get_tool_path('serial-loader')
-    send_file2mem(serial_loader, 0x00000000)
-    execute(0x00000000)
-
-    sleep(0.05)
-    if sync() == False:
-        log.die("Sync failed!")
-
-    send_file2partion(image, partition)
-
-    partion_set_boot(partition)
-
-    reboot()
-
-    deinit_serial_device()
+    finish_serial_loader()
 
 
 def load_to_sdcard(serial_name, image, target_name):
-    init_serial_device(serial_name)
+    start_timing('load_to_sdcard', image)
+    with timing_phase('open'):
+        init_serial_device(serial_name)
 
-    reset_to_download()
-    if sync() == False:
-        log.die("Sync failed!")
+    open_serial_loader(board_info = True)
 
-    sync_baud(3000000)
-    if sync() == False:
-        log.die("Sync failed!")
+    with timing_phase('transfer'):
+        if not SKIP_IDENTICAL or not is_identical(Path(image), 'file', target_name):
+            send_file2sdcard(image, target_name)
 
-    get_board_info()
+    finish_serial_loader()
 
 
-    serial_loader = util.get_tool_path('serial-loader')
-    send_file2mem(serial_loader, 0x00000000)
-    execute(0x00000000)
+def verify_image(serial_name, image, kind, target):
+    start_timing('verify', image)
+    with timing_phase('open'):
+        init_serial_device(serial_name)
 
-    sleep(0.05)
-    if sync() == False:
-        log.die("Sync failed!")
+    open_serial_loader()
 
-    send_file2sdcard(image, target_name)
-    reboot()
-
-    deinit_serial_device()
-
-
-
-
-def copy_to_filesystem(serial_name, delete, source, destination, files):
-    init_serial_device(serial_name)
-
-    reset_to_download()
-    if sync() == False:
-        log.die("Sync failed!")
-
-    sync_baud(3000000)
-    if sync() == False:
-        log.die("Sync failed!")
-
-    serial_loader = util.get_tool_path('serial-loader')
-    send_file2mem(serial_loader, 0x00000000)
-    execute(0x00000000)
-
-    sleep(0.05)
-    if sync() == False:
-        log.die("Sync failed!")
+    f = Path(image)
+    if not f.is_file():
+        log.die('open file ' + str(f) + ' failed!')
 
-    if delete:
-        rm(str(destination / source))
+    with timing_phase('verify'):
+        process_bar = get_process_bar(f.stat().st_size)
+        verified, offset = get_first_difference(f, kind, target, process_bar)
+        process_bar.close()
 
-    for file in files:
-        des = destination / file
-        cp(str(file), str(des))
+    finish_serial_loader()
 
-    reboot()
-    deinit_serial_device()
+    if not verified:
+        log.die(get_label() + 'The serial loader cannot read back ' + target)
+    if offset is not None:
+        log.die(get_label() + target + ' differs from ' + str(f) + ' at byte ' + str(offset))
 
+    log.inf(get_label() + target + ' matches ' + str(f))
 
 
+def verify_partition(serial_name, image, partition):
+    verify_image(serial_name, image, 'partition', partition)
 
-IMAGE1 = Path('./micro.img')
-IMAGE2 = Path('./clear_to_AA.bin')
 
-def test_load_to_ram(serial_name, address):
+def verify_sdcard(serial_name, image, target_name):
+    verify_image(serial_name, image, 'file', target_name)
 
-    init_serial_device(serial_name)
-    count = 0
-    mbytes = 0
 
-    i1_size = IMAGE1.stat().st_size / 1024 / 1024.0
-    i2_size = IMAGE2.stat().st_size / 1024 / 1024.0
+def copy_to_filesystem(serial_name, delete, source, destination, files, manifest_path = None):
+    start_timing('copy_to_filesystem')
+    with timing_phase('open'):
+        init_serial_device(serial_name)
 
-    while True:
-        change_host_baud(115200)
-        reset_to_download()
-        sync()
+    open_serial_loader()
 
-        sync_baud(3000000)
-        sync()
+    with timing_phase('transfer'):
+        copy_changed_files(delete, source, destination, files, manifest_path)
 
-        if count % 2 == 0:
-            send_file2mem(IMAGE2, address, True)
-            mbytes += i2_size
-        else:
-            send_file2mem(IMAGE1, address, True)
-            mbytes += i1_size
-        
-        #deinit_serial_device()
-        count += 1
+    finish_serial_loader()
 
-        log.inf('------ count = ' + str(count) + ' transfer ' + str(mbytes) + 'mb' + ' ------')
 
+def load_to_devices(ports, function, *args):
+    # Run one of the load_to_*() functions on every port at once, each board
+    # gets its own Device in a worker thread
+    def run(index, port):
+        device = Device(label=port, position=index)
+        use_device(device)
+        result = {'port': port, 'ok': False, 'error': None}
 
-#log.set_verbosity(log.VERBOSE_DBG)
-#test_load_to_ram('wch', 0x80000000)
\ No newline at end of file
+        start = monotonic()
+        try:
+            function(port, *args)
+            result['ok'] = True
+        except SystemExit as e:
+            result['error'] = 'exit code ' + str(e.code)
+        except Exception as e:
+            result['error'] = str(e)
+        finally:
+            record_metrics()
+            if device.port is not None and device.port.is_open:
+                device.port.close()
+
+        result['seconds'] = monotonic() - start
+        result['baudrate'] = device.baudrate
+        result['link_errors'] = device.link_errors
+        return result
+
+    with ThreadPoolExecutor(max_workers=min(len(ports), PARALLEL_DEVICES)) as pool:
+        return list(pool.map(run, range(len(ports)), ports))
@@ -0,0 +1,219 @@
+import asyncio, threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tqdm import tqdm
+from zlib import crc32
+import log
+import serial_download as sd
+
+
+# Number of data frames read, checksummed and compressed ahead of the wire
+PREPARE_AHEAD = 2
+
+
+class DownloadError(Exception):
+    pass
+
+
+def receive_frame():
+    # The response buffer of the device is reused by the next response, the
+    # event loop gets a copy
+    response = sd.wait_response()
+
+    return None if response is None else bytes(response)
+
+
+def prepare_payload(file, lock, offset, length, compress, file_crc):
+    # A read of a producer cancelled by a resume may still be running
+    payload = bytearray(length)
+    with lock:
+        file.seek(offset)
+        if sd.read_payload(file, memoryview(payload)) != length:
+            raise DownloadError('read ' + file.name + ' failed, the file was changed during the transfer')
+    file_crc = crc32(payload, file_crc)
+
+    deflated = False
+    if compress:
+        compressed = sd.compress_payload(payload)
+        if len(compressed) < length:
+            payload = compressed
+            deflated = True
+
+    return payload, deflated, offset, length, file_crc
+
+
+class AsyncDevice:
+    '''Drives one board from an asyncio event loop.
+
+    pyserial only offers blocking calls, so all port I/O of a board runs in a
+    thread of its own, in request order. File reads, CRCs and compression of
+    the next frames run in the default executor while the current frame is
+    on the wire, and many boards can be driven from one loop::
+
+        await asyncio.gather(*(load_to_partition(port, image, 'user') for port in ports))
+    '''
+
+    def __init__(self, port_name, label=None, position=None):
+        self.port_name = port_name
+        self.device = sd.Device(label=label, position=position)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.file_lock = threading.Lock()
+
+    def call(self, function, args):
+        sd.use_device(self.device)
+        try:
+            return function(*args)
+        except SystemExit:
+            raise DownloadError(function.__name__ + ' failed on ' + self.port_name) from None
+
+    async def run(self, function, *args):
+        # Run a blocking serial_download function against this board
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(self.executor, self.call, function, args)
+
+    async def open(self):
+        await self.run(sd.init_serial_device, self.port_name)
+
+    async def close(self):
+        # Metrics of a failed transfer are kept as well
+        await self.run(sd.record_metrics)
+        await self.run(sd.deinit_serial_device)
+        self.executor.shutdown(wait=False)
+
+    async def send_request(self, tag, payload=None):
+        await self.run(sd.send_request, tag, payload)
+
+    async def wait_response(self):
+        return await self.run(receive_frame)
+
+    async def request(self, tag, payload=None):
+        await self.send_request(tag, payload)
+
+        return sd.response_verify(await self.wait_response(), tag)
+
+    async def prepare_frames(self, file, file_length, compress, queue, offset, file_crc):
+        loop = asyncio.get_running_loop()
+        payload_length = sd.get_payload_length(self.device)
+
+        while offset < file_length:
+            length = min(payload_length, file_length - offset)
+            frame = await loop.run_in_executor(None, prepare_payload, file, self.file_lock, offset, length, compress, file_crc)
+            file_crc = frame[4]
+            offset += length
+            await queue.put(frame)
+
+    async def send_data_frames(self, tag, file, file_length, process_bar):
+        # Windowing, retries and resume are serial_download.FrameWindow's,
+        # returns the CRC32 of the data sent or None if a frame failed
+        window = sd.get_data_window(tag, self.device)
+        max_length = sd.get_payload_length(self.device)
+        previous_timeout = await self.run(sd.set_read_timeout, sd.get_data_timeout(window, max_length))
+        try:
+            return await self.send_frames(tag, file, file_length, process_bar, window)
+        finally:
+            await self.run(sd.set_read_timeout, previous_timeout)
+
+    async def send_frames(self, tag, file, file_length, process_bar, window):
+        compress = sd.COMPRESSION and 'deflate' in self.device.loader_features and tag in sd.COMPRESSION_TAGS
+        frames = sd.FrameWindow(tag, file_length, window, process_bar, self.device)
+
+        while True:
+            queue = asyncio.Queue(PREPARE_AHEAD)
+            producer = asyncio.ensure_future(self.prepare_frames(file, file_length, compress, queue, frames.offset, frames.file_crc))
+            frames.resumed = False
+            try:
+                while not frames.is_done() and not frames.resumed:
+                    if not frames.can_send():
+                        if not await self.run(frames.receive):
+                            return None
+                        continue
+
+                    payload, deflated, frame_offset, length, frame_crc = await queue.get()
+                    await self.send_request(tag | sd.DATA_DEFLATE_FLAG if deflated else tag, payload)
+                    frames.sent(length, frame_crc)
+            finally:
+                producer.cancel()
+
+            if frames.is_done():
+                return frames.file_crc
+
+    async def send_data(self, tag, file, file_length, begin, process_bar):
+        while True:
+            await self.run(begin, file_length)
+            file_crc = await self.send_data_frames(tag, file, file_length, process_bar)
+            if file_crc is not None:
+                return file_crc
+
+            sd.count_link_error('restarted', self.device)
+            if sd.get_data_window(tag, self.device) > 1:
+                log.wrn(self.port_name + ': Pipelined transfer failed, falling back to stop-and-wait mode')
+                self.device.data_window[tag] = 1
+                if not await self.run(sd.sync, 6, False):
+                    return None
+            elif not await self.run(sd.lower_baudrate):
+                return None
+
+            process_bar.reset()
+
+    async def send_file(self, file_name, tag, begin, end):
+        f = Path(file_name)
+        if not f.is_file():
+            raise DownloadError('open file ' + str(f) + ' failed!')
+
+        file_length = f.stat().st_size
+        process_bar = tqdm(total=file_length, unit='B', unit_scale=True, desc=self.device.label, position=self.device.position)
+        with f.open('rb', buffering=0) as file:
+            file_crc = await self.send_data(tag, file, file_length, begin, process_bar)
+        process_bar.close()
+
+        if file_crc is None:
+            raise DownloadError('sending ' + str(f) + ' to ' + self.port_name + ' failed')
+
+        await self.run(end, file_crc)
+
+
+async def load_to_partition(serial_name, image, partition, label=None, position=None):
+    device = AsyncDevice(serial_name, label, position)
+    try:
+        await device.run(sd.start_timing, 'load_to_partition', image)
+        await device.open()
+        await device.run(sd.open_serial_loader, True, True)
+
+        if not sd.SKIP_IDENTICAL or not await device.run(sd.is_identical, Path(image), 'partition', partition):
+            if not sd.DELTA_UPDATE or not await device.run(sd.send_file2partion_delta, Path(image), partition):
+                await device.send_file(image, sd.PARTION_DATA_TAG, lambda length: sd.partion_begin(partition, length), sd.partion_end)
+
+        await device.run(sd.partion_set_boot, partition)
+        await device.run(sd.finish_serial_loader)
+    finally:
+        await device.close()
+
+
+async def load_to_sdcard(serial_name, image, target_name, label=None, position=None):
+    device = AsyncDevice(serial_name, label, position)
+    try:
+        await device.run(sd.start_timing, 'load_to_sdcard', image)
+        await device.open()
+        await device.run(sd.open_serial_loader, True)
+
+        if not sd.SKIP_IDENTICAL or not await device.run(sd.is_identical, Path(image), 'file', target_name):
+            await device.send_file(image, sd.FS_DATA_TAG, lambda length: sd.sdcard_begin(length, target_name), sd.sdcard_end)
+
+        await device.run(sd.finish_serial_loader)
+    finally:
+        await device.close()
+
+
+async def copy_to_filesystem(serial_name, delete, source, destination, files, manifest_path=None, label=None, position=None):
+    device = AsyncDevice(serial_name, label, position)
+    try:
+        await device.run(sd.start_timing, 'copy_to_filesystem')
+        await device.open()
+        await device.run(sd.open_serial_loader)
+
+        await device.run(sd.copy_changed_files, delete, source, destination, files, manifest_path)
+
+        await device.run(sd.finish_serial_loader)
+    finally:
+        await device.close()
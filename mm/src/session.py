@@ -0,0 +1,361 @@
+import os, sys, json, socket, subprocess, traceback
+from contextlib import redirect_stdout, redirect_stderr
+from time import sleep, monotonic
+from pathlib import Path
+import log, metrics
+import serial_download as sd
+
+
+SESSION_SOCKET = Path.home() / '.madmachine' / 'session.sock'
+SESSION_LOG = Path.home() / '.madmachine' / 'session.log'
+SESSION_CONNECT_TIMEOUT = 1
+SESSION_START_TIMEOUT = 30
+
+# serial_download entry points a command may forward to the session
+SESSION_FUNCTIONS = ['load_to_ram', 'load_to_partition', 'load_to_sdcard', 'copy_to_filesystem', 'verify_partition', 'verify_sdcard']
+
+# serial_download settings that travel with a forwarded command
+SESSION_SETTINGS = ['DATA_WINDOW_SIZE', 'TARGET_BAUDRATE', 'DELTA_UPDATE', 'COMPRESSION', 'TIMING', 'SKIP_IDENTICAL', 'BATCH_COPY', 'INCREMENTAL_COPY', 'TRUST_LOCAL_MANIFEST']
+
+# Cleared by --no-session
+USE_SESSION = True
+
+
+def is_supported():
+    return hasattr(socket, 'AF_UNIX')
+
+
+def encode_value(value):
+    if isinstance(value, Path):
+        return {'path': str(value)}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item) for item in value]
+
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict) and 'path' in value:
+        return Path(value['path'])
+    if isinstance(value, list):
+        return [decode_value(item) for item in value]
+
+    return value
+
+
+def send_message(connection, message):
+    connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+class SessionOutput:
+    '''File object that forwards the output of a command to the client.'''
+
+    def __init__(self, connection, stream):
+        self.connection = connection
+        self.stream = stream
+
+    def write(self, text):
+        if len(text) > 0:
+            try:
+                send_message(self.connection, {self.stream: text})
+            except OSError:
+                # The client went away, finish the command anyway
+                pass
+
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def connect():
+    if not USE_SESSION or not is_supported() or not SESSION_SOCKET.exists():
+        return None
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(SESSION_CONNECT_TIMEOUT)
+    try:
+        connection.connect(str(SESSION_SOCKET))
+    except OSError:
+        connection.close()
+        return None
+
+    connection.settimeout(None)
+    return connection
+
+
+def request(connection, message):
+    send_message(connection, message)
+
+    for line in connection.makefile('r', encoding='utf-8'):
+        reply = json.loads(line)
+        if 'out' in reply:
+            sys.stdout.write(reply['out'])
+            sys.stdout.flush()
+        if 'err' in reply:
+            sys.stderr.write(reply['err'])
+            sys.stderr.flush()
+        if 'reject' in reply:
+            log.dbg(reply['reject'])
+            return None
+        if 'exit' in reply:
+            return reply['exit']
+
+    log.die('The session closed the connection')
+
+
+def call(function, *args):
+    # Run a serial_download entry point in the session that owns the port,
+    # or in this process if no session is running or it serves another
+    # board. Captures and metrics have to be written by the process that
+    # talks to the port, so they always run here
+    connection = None
+    if sd.CAPTURE is None and not metrics.is_enabled():
+        connection = connect()
+
+    if connection is None:
+        return getattr(sd, function)(*args)
+
+    log.dbg('Forwarding ' + function + ' to the session on ' + str(SESSION_SOCKET))
+    message = {
+        'function': function,
+        'args': encode_value(list(args)),
+        'cwd': os.getcwd(),
+        'port': args[0],
+        'serial': sd.SERIAL_NUMBER,
+        'settings': {name: getattr(sd, name) for name in SESSION_SETTINGS},
+        'verbosity': log.VERBOSE
+    }
+    with connection:
+        exit_code = request(connection, message)
+
+    if exit_code is None:
+        return getattr(sd, function)(*args)
+    if exit_code != 0:
+        sys.exit(exit_code)
+
+
+def start_loader(serial_name):
+    sd.init_serial_device(serial_name)
+    sd.open_serial_loader()
+    sd.save_loader_state()
+
+
+def get_board(serial_name):
+    port_path = sd.get_device().port.port
+
+    return {'name': serial_name, 'port': port_path, 'serial': sd.get_serial_number(port_path, sd.get_serial_ports())}
+
+
+def is_board(board, port_name, serial_number):
+    # port_name is what the client would have opened, the session's own
+    # --port, a path or a pattern such as the default wch
+    if serial_number is not None and serial_number != board['serial']:
+        return False
+    if port_name is None or port_name == board['name'] or port_name == board['port']:
+        return True
+    if os.path.realpath(port_name) == os.path.realpath(board['port']):
+        return True
+
+    return any(port.device == board['port'] and sd.match_serial_port(port, port_name) for port in sd.get_serial_ports())
+
+
+def release_port():
+    sd.HOLD_PORT = False
+    sd.deinit_serial_device()
+    sd.HOLD_PORT = True
+
+
+def run_command(connection, message, board, reboot):
+    function = message.get('function')
+    if function not in SESSION_FUNCTIONS:
+        send_message(connection, {'err': 'Unknown session command ' + str(function) + '\n', 'exit': 2})
+        return
+    if not is_board(board, message.get('port'), message.get('serial')):
+        send_message(connection, {'reject': 'The session serves ' + board['port'] + ', not the requested board'})
+        return
+
+    settings = {name: getattr(sd, name) for name in SESSION_SETTINGS}
+    for name, value in message.get('settings', {}).items():
+        if name in SESSION_SETTINGS:
+            setattr(sd, name, value)
+    verbosity = log.VERBOSE
+    log.set_verbosity(message.get('verbosity', verbosity))
+    sd.KEEP_LOADER = not reboot
+
+    # The client named the same board, possibly by another pattern
+    args = decode_value(message.get('args', []))
+    args[0] = board['name']
+
+    cwd = os.getcwd()
+    exit_code = 0
+    with redirect_stdout(SessionOutput(connection, 'out')), redirect_stderr(SessionOutput(connection, 'err')):
+        try:
+            os.chdir(message.get('cwd', cwd))
+            getattr(sd, function)(*args)
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            os.chdir(cwd)
+
+    for name, value in settings.items():
+        setattr(sd, name, value)
+    log.set_verbosity(verbosity)
+
+    if exit_code != 0:
+        # The link state is unknown after a failure, the next command
+        # reopens the port and bootstraps the loader again
+        sd.clear_loader_state()
+        release_port()
+
+    send_message(connection, {'exit': exit_code})
+
+
+def get_status(stats):
+    port = sd.get_device().port
+    if port is None or not port.is_open:
+        return 'Session on ' + str(SESSION_SOCKET) + '\n  port: closed\n'
+
+    state = sd.load_loader_state()
+
+    return ('Session on ' + str(SESSION_SOCKET) + '\n'
+            + '  port: ' + port.port + '\n'
+            + '  loader: ' + ('running at ' + str(state.get('baudrate')) + ' baud' if state is not None else 'not running') + '\n'
+            + '  commands: ' + str(stats['commands']) + '\n'
+            + '  uptime: ' + '{:.0f}s'.format(monotonic() - stats['started']) + '\n')
+
+
+def handle_connection(connection, board, reboot, stats):
+    line = connection.makefile('r', encoding='utf-8').readline()
+    if line == '':
+        return True
+
+    message = json.loads(line)
+    command = message.get('command', 'run')
+    if command == 'status':
+        send_message(connection, {'out': get_status(stats), 'exit': 0})
+    elif command == 'stop':
+        send_message(connection, {'out': 'Session stopped\n', 'exit': 0})
+        return False
+    else:
+        stats['commands'] += 1
+        run_command(connection, message, board, reboot)
+
+    return True
+
+
+def stop_loader():
+    # Leave the board running the latest firmware
+    port = sd.get_device().port
+    if port is None or not port.is_open or sd.load_loader_state() is None:
+        return
+
+    sd.clear_loader_state()
+    try:
+        sd.reboot()
+    except SystemExit:
+        log.wrn('Reboot the board manually to run the new firmware')
+
+
+def serve(serial_name, reboot):
+    if not is_supported():
+        log.die('mm session needs Unix domain sockets, which are not available on this platform')
+
+    connection = connect()
+    if connection is not None:
+        connection.close()
+        log.die('A session is already running on ' + str(SESSION_SOCKET))
+
+    sd.HOLD_PORT = True
+    start_loader(serial_name)
+    board = get_board(serial_name)
+
+    SESSION_SOCKET.parent.mkdir(parents=True, exist_ok=True)
+    if SESSION_SOCKET.exists():
+        SESSION_SOCKET.unlink()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(SESSION_SOCKET))
+    os.chmod(SESSION_SOCKET, 0o600)
+    server.listen(4)
+    log.inf('Session serving ' + sd.get_device().port.port + ' on ' + str(SESSION_SOCKET))
+
+    stats = {'started': monotonic(), 'commands': 0}
+    running = True
+    try:
+        while running:
+            connection, address = server.accept()
+            with connection:
+                try:
+                    running = handle_connection(connection, board, reboot, stats)
+                except (OSError, ValueError) as e:
+                    log.wrn('Session request failed: ' + str(e))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if SESSION_SOCKET.exists():
+            SESSION_SOCKET.unlink()
+        stop_loader()
+        release_port()
+
+    log.inf('Session stopped')
+
+
+def detach(args):
+    # Start the same mm executable again in the background and wait until
+    # it is ready to accept commands
+    command = [sys.executable]
+    if not getattr(sys, 'frozen', False):
+        command.append(sys.argv[0])
+    command += ['session', 'start']
+    if args.port is not None:
+        command += ['--port', args.port]
+    if args.serial is not None:
+        command += ['--serial', args.serial]
+    if args.reboot:
+        command.append('--reboot')
+    if args.verbose:
+        command.append('-v')
+
+    SESSION_LOG.parent.mkdir(parents=True, exist_ok=True)
+    with SESSION_LOG.open('w') as output:
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=output, stderr=subprocess.STDOUT, start_new_session=True)
+
+    deadline = monotonic() + SESSION_START_TIMEOUT
+    while monotonic() < deadline:
+        connection = connect()
+        if connection is not None:
+            connection.close()
+            log.inf('Session started, pid ' + str(process.pid) + ', log in ' + str(SESSION_LOG))
+            return
+        if process.poll() is not None:
+            break
+        sleep(0.1)
+
+    log.die('Session failed to start, see ' + str(SESSION_LOG))
+
+
+def session(args):
+    if args.action == 'start':
+        if args.detach:
+            detach(args)
+        else:
+            serve(args.port if args.port is not None else 'wch', args.reboot)
+        return
+
+    connection = connect()
+    if connection is None:
+        log.die('No session is running')
+
+    with connection:
+        exit_code = request(connection, {'command': args.action})
+
+    if exit_code != 0:
+        sys.exit(exit_code)